@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Client, CreditNote, Invoice, InvoiceItem, Profile, Project, TimeEntry
+from .models import Client, CreditNote, Holiday, Invoice, InvoiceItem, Profile, Project, RenderJob, SyncState, TimeEntry, \
+    TogglImportWindow, WorkCalendar
 from admin_views.admin import AdminViews
 
 
@@ -7,6 +8,10 @@ class InvoiceItemInline(admin.TabularInline):
     model = InvoiceItem
 
 
+class HolidayInline(admin.TabularInline):
+    model = Holiday
+
+
 class ProjectAdmin(AdminViews):
     admin_views = (
         ('Generate Timesheet', 'generate_timesheet'),
@@ -23,6 +28,11 @@ class TimeEntryAdmin(admin.ModelAdmin):
     list_filter = ('project__name',)
 
 
+class WorkCalendarAdmin(admin.ModelAdmin):
+    list_display = ('name', 'country', 'weekmask',)
+    inlines = [HolidayInline]
+
+
 admin.site.register(Project, ProjectAdmin)
 
 admin.site.register(Client)
@@ -30,4 +40,8 @@ admin.site.register(CreditNote)
 admin.site.register(Invoice, InvoiceAdmin)
 admin.site.register(InvoiceItem)
 admin.site.register(Profile)
-admin.site.register(TimeEntry, TimeEntryAdmin)
\ No newline at end of file
+admin.site.register(RenderJob)
+admin.site.register(SyncState)
+admin.site.register(TimeEntry, TimeEntryAdmin)
+admin.site.register(TogglImportWindow)
+admin.site.register(WorkCalendar, WorkCalendarAdmin)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class InvoicingConfig(AppConfig):
     name = 'invoicing'
+
+    def ready(self):
+        from . import signals  # noqa: connects the signal receivers
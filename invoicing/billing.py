@@ -0,0 +1,61 @@
+from datetime import timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import TruncDate
+from .models import CacheGeneration, Invoice, TimeEntry
+
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def uninvoiced_entries(**filters):
+    """
+    Billable time entries matching the filters that are not covered by an invoice of their project: they are not
+    linked to an invoice, and (for entries from before invoices were linked) no invoice of the project has a
+    start..end period (both inclusive) containing the day of the entry. A single query with a NOT EXISTS subquery,
+    which uses the (project, start, end) index of the invoices.
+    """
+    covering_invoices = Invoice.objects.filter(project=OuterRef('project'), start__lte=OuterRef('day'),
+                                               end__gte=OuterRef('day'))
+    return TimeEntry.objects.billable().filter(invoice__isnull=True, **filters).annotate(day=TruncDate('start'))\
+        .annotate(invoiced=Exists(covering_invoices)).filter(invoiced=False)
+
+
+def uninvoiced_totals():
+    """
+    Hours of uninvoiced billable time per project id, cached until time entries are imported or invoices change
+    """
+    key = 'billing:{0}:uninvoiced_totals'.format(CacheGeneration.current('billing'))
+    totals = cache.get(key)
+    if totals is None:
+        totals = dict(uninvoiced_entries().order_by().values('project').annotate(hours=TimeEntry.objects.hours())
+                      .values_list('project', 'hours'))
+        cache.set(key, totals, CACHE_TIMEOUT)
+    return totals
+
+
+def invalidate():
+    """
+    Drop the cached totals, in all processes (the generation is kept in the database)
+    """
+    CacheGeneration.invalidate('billing')
+
+
+def create_invoice(project, start, end, delivery_date=None, days=None, description=None):
+    """
+    Create an invoice for a project and period (both dates inclusive) and link the billable time entries of the period
+    that are not invoiced yet to it, with a single UPDATE. Without `days`, the invoiced days (of 8 hours) are the sum
+    of the linked entries, computed by the database.
+    """
+    with transaction.atomic():
+        invoice = Invoice(project=project, start=start, end=end, delivery_date=delivery_date, days=days or 0,
+                          description=description)
+        invoice.save()
+        TimeEntry.objects.billable().for_project(project).in_range(start, end + timedelta(days=1))\
+            .filter(invoice__isnull=True).update(invoice=invoice)
+        if days is None:
+            hours = invoice.time_entries.aggregate(hours=TimeEntry.objects.hours())['hours'] or 0
+            invoice.days = Decimal(str(hours / 8.0)).quantize(Decimal('0.01'))
+            invoice.save()
+    return invoice
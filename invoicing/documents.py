@@ -0,0 +1,226 @@
+import os
+import zipfile
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from django.db.models.functions import TruncDate
+from django.template import loader
+from .models import CreditNote, Invoice, Project, TimeEntry
+from .planning import business_calendar
+from .rendering import timed_html_to_pdf
+from .timesheet import reindex_days, weekly_calendar
+
+# everything needed to render a timesheet, invoice or creditnote: the template, its context, a file name for the pdf
+# and the tags under which the pdf can be cached (no tags: not cached)
+Document = namedtuple('Document', ['template', 'context', 'filename', 'cache_tags'])
+
+
+def timesheet_document(project, start_str, end_str, time_unit='days'):
+    """
+    Timesheet of a project from start to end (both yyyy-mm-dd, inclusive), with totals in days or hours
+    """
+    start = datetime.strptime(start_str, '%Y-%m-%d')
+    end = datetime.strptime(end_str, '%Y-%m-%d') + timedelta(days=1)
+    unit_hours = 8.0 if time_unit == 'days' else 1.0
+    entries = TimeEntry.objects.billable()
+    daily = reindex_days(entries.daily_totals(project, start.date(), end.date()), start_str, end_str)
+    total = daily.sum() / unit_hours
+    entries_by_week = weekly_calendar(daily, business_calendar(profile=project.user))
+    # lazy: only queried when the template lists the individual entries
+    timeentries = entries.for_project(project).in_range(start.date(), end.date())\
+        .annotate(date=TruncDate('start')).order_by('start').values('date', 'start', 'duration', 'duration_unit')
+    start_out_str = start.strftime('%d-%m-%Y')
+    end_out_str = (end - timedelta(days=1)).strftime('%d-%m-%Y')
+
+    context = {
+        'client': project.client,
+        'description': 'description',
+        'end': end_out_str,
+        'start': start_out_str,
+        'entries_by_week': entries_by_week,
+        'timeentries': timeentries,
+        'total': '{0:.1f}'.format(total),
+        'time_unit': time_unit,
+        'user': project.user
+    }
+    template = project.timesheet_template if project.timesheet_template else 'calendar_timesheet.html'
+    return Document(template, context, f'{project}_timesheet_{start_out_str}_{end_out_str}.pdf', ())
+
+
+class InvoiceContextBuilder(object):
+    """
+    Builds invoice documents with a fixed number of queries: the invoices are loaded together with their project,
+    client and user (one join) and all their invoice items (one extra query), however many invoices are built.
+    """
+    date_format = '%d/%m/%Y'
+
+    def queryset(self):
+        return Invoice.objects.select_related('project__client', 'project__user').prefetch_related('invoiceitem_set')
+
+    def get(self, invoice_id):
+        return self.queryset().get(pk=invoice_id)
+
+    def load(self, invoices):
+        """
+        :param invoices: invoice ids or a queryset of invoices
+        :return: list of the invoices ordered by number, with everything needed to build their documents loaded
+        """
+        return list(self.queryset().filter(pk__in=invoices).order_by('number'))
+
+    def context(self, invoice):
+        project = invoice.project
+        invoice_items = [
+            {'description': '{} dagen ontwikkeling aan €{} per dag (waarvan 15% auteursrechten)'.format(invoice.days, project.rate),
+             'price': '{0:.2f}'.format(invoice.days * project.rate),
+             'vat': '{0:.2f}'.format(invoice.days * project.rate * invoice.vat_rate),
+             'vat_rate': int(project.vat_rate * 100)}]
+        # prefetched: iterating does not query the database again
+        for item in invoice.invoiceitem_set.all():
+            item_vat_rate = item.vat_rate if item.vat_rate else invoice.vat_rate
+            invoice_items.append({
+                'description': item.description,
+                'price': '{0:.2f}'.format(item.price),
+                'vat': '{0:.2f}'.format(item.price * item_vat_rate),
+                'vat_rate': int(item_vat_rate * 100)})
+
+        return {
+            'client': project.client,
+            'user': project.user,
+            'invoice_number': invoice.number,
+            'start': invoice.start.strftime(self.date_format),
+            'end': invoice.end.strftime(self.date_format),
+            'invoice_date': invoice.date.strftime(self.date_format),
+            'invoice_delivery_date': invoice.delivery_date.strftime(self.date_format),
+            'invoice_items': invoice_items,
+            'description': invoice.description,
+            'nr_of_days': '{0:.2f}'.format(invoice.days),
+            'rate': '{0:.2f}'.format(project.rate),
+            'total': '{0:.2f}'.format(invoice.total_excl_vat),
+            'vat': '{0:.2f}'.format(invoice.total_vat) if invoice.total_vat > 0 else '0.00 (customer is VAT exempt)',
+            'total_vat': '{0:.2f}'.format(invoice.total_incl_vat),
+        }
+
+    def document(self, invoice):
+        project = invoice.project
+        template = project.invoice_template if not invoice.is_credit_invoice else project.credit_template
+        return Document(template, self.context(invoice), f'{invoice.number}_invoice_{project}.pdf',
+                        (f'invoice-{invoice.pk}', f'project-{invoice.project_id}'))
+
+    def documents(self, invoices):
+        return [self.document(invoice) for invoice in self.load(invoices)]
+
+
+def invoice_document(invoice):
+    return InvoiceContextBuilder().document(invoice)
+
+
+def creditnote_document(creditnote):
+    date_format = '%d/%m/%Y'
+    context = {
+        'client': creditnote.project.client,
+        'user': creditnote.project.user,
+        'creditnote_number': creditnote.number,
+        'creditnote_date': creditnote.date.strftime(date_format),
+        'description': creditnote.description,
+        'total': '{0:.2f}'.format(creditnote.total_excl_vat),
+        'vat': '{0:.2f}'.format(creditnote.total_vat),
+        'total_vat': '{0:.2f}'.format(creditnote.total_incl_vat),
+    }
+
+    template = creditnote.project.credit_template
+    return Document(template, context, f'{creditnote.number}_creditnote_{creditnote.project}.pdf',
+                    (f'creditnote-{creditnote.pk}', f'project-{creditnote.project_id}'))
+
+
+def request_document(kind, parameters):
+    """
+    The document of a given kind ('timesheet', 'invoice' or 'creditnote') for the query parameters of the
+    display_timesheet, display_invoice or display_creditnote view
+    """
+    if kind == 'timesheet':
+        project = Project.objects.get(pk=int(parameters.get('project', '1')))
+        return timesheet_document(project, parameters.get('start', '2017-01-01'), parameters.get('end', '2017-12-31'),
+                                  parameters.get('unit', 'days'))
+    elif kind == 'invoice':
+        builder = InvoiceContextBuilder()
+        return builder.document(builder.get(int(parameters.get('invoiceId', '1'))))
+    elif kind == 'creditnote':
+        return creditnote_document(CreditNote.objects.get(pk=int(parameters.get('creditnoteId', '1'))))
+    raise ValueError(f'Unknown document kind: {kind}')
+
+
+# per kind: the query parameter with the id of the document's object, and its model
+DOCUMENT_OBJECTS = {
+    'timesheet': ('project', Project),
+    'invoice': ('invoiceId', Invoice),
+    'creditnote': ('creditnoteId', CreditNote),
+}
+
+
+def check_parameters(kind, parameters):
+    """
+    Raise ValueError if request_document would fail for these parameters: an unknown kind, a malformed id or date,
+    or an object that does not exist. The document itself is not built.
+    """
+    if kind not in DOCUMENT_OBJECTS:
+        raise ValueError(f'Unknown document kind: {kind}')
+    name, model = DOCUMENT_OBJECTS[kind]
+    try:
+        pk = int(parameters.get(name, '1'))
+    except ValueError:
+        raise ValueError(f'Invalid {name}: {parameters[name]}')
+    if kind == 'timesheet':
+        for date_name in ('start', 'end'):
+            if date_name in parameters:
+                datetime.strptime(parameters[date_name], '%Y-%m-%d')
+    if not model.objects.filter(pk=pk).exists():
+        raise ValueError(f'Unknown {name}: {pk}')
+
+
+def render_html(document, request=None):
+    return loader.render_to_string(document.template, document.context, request, using=None)
+
+
+def select_documents(invoice_ids=(), creditnote_ids=(), month=None):
+    """
+    The invoice and creditnote documents with the given ids, plus all invoices dated in month (a (year, month) tuple)
+    """
+    invoices = Invoice.objects.filter(pk__in=invoice_ids)
+    if month:
+        invoices = invoices | Invoice.objects.filter(date__year=month[0], date__month=month[1])
+    creditnotes = CreditNote.objects.filter(pk__in=creditnote_ids)
+    return InvoiceContextBuilder().documents(invoices) + \
+        [creditnote_document(creditnote) for creditnote in creditnotes.order_by('number')]
+
+
+def render_documents(documents, output, workers=None):
+    """
+    Render documents to pdf in parallel. The html is rendered in this process, the CPU bound conversion to pdf is
+    spread over a pool of `workers` processes (default: one per CPU). The worker processes never touch the database.
+
+    :param output: directory to write the pdf files to, or the path of a zip file (ending on .zip) to create
+    :return: list of {'filename', 'seconds', 'bytes'} dicts, one per document
+    """
+    pages = [(document.filename, render_html(document)) for document in documents]
+    report = []
+    if not pages:
+        return report
+    to_zip = output.endswith('.zip')
+    if to_zip:
+        archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+    else:
+        os.makedirs(output, exist_ok=True)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for filename, pdf, seconds in pool.map(timed_html_to_pdf, *zip(*pages)):
+                if to_zip:
+                    archive.writestr(filename, pdf)
+                else:
+                    with open(os.path.join(output, filename), 'wb') as f:
+                        f.write(pdf)
+                report.append({'filename': filename, 'seconds': seconds, 'bytes': len(pdf)})
+    finally:
+        if to_zip:
+            archive.close()
+    return report
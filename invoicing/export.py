@@ -0,0 +1,100 @@
+import csv
+import pandas as pd
+
+from django.db import models
+from .models import Invoice, InvoiceItem, TimeEntry
+
+# the models that can be exported, by export name
+EXPORTS = {
+    'timeentries': TimeEntry,
+    'invoices': Invoice,
+    'invoiceitems': InvoiceItem,
+}
+
+
+def export_fields(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def iter_chunks(model, chunk_size=2000):
+    """
+    All rows of a model as value tuples, in chunks of at most chunk_size rows ordered by primary key. Every chunk is
+    a separate query for the rows after the last primary key of the previous chunk, so only one chunk is in memory
+    at a time, also on databases that do not stream query results.
+    """
+    fields = export_fields(model)
+    pk_index = fields.index(model._meta.pk.attname)
+    queryset = model.objects.order_by('pk').values_list(*fields)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        chunk = list(queryset.filter(pk__gt=chunk[-1][pk_index])[:chunk_size]) if len(chunk) == chunk_size else []
+
+
+class Echo(object):
+    """
+    File-like object that returns what is written to it, so csv.writer can produce lines for a generator
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(model, chunk_size=2000):
+    """
+    The rows of a model as CSV, one line at a time, with a header line first
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(export_fields(model))
+    for chunk in iter_chunks(model, chunk_size):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+
+def arrow_schema(model):
+    """
+    The arrow schema matching the model fields, so that every chunk is written with the same column types (a chunk
+    in which a nullable column happens to be empty would otherwise get a different type)
+    """
+    import pyarrow as pa
+
+    columns = []
+    for field in model._meta.concrete_fields:
+        name = field.attname
+        if isinstance(field, models.ForeignKey):
+            field = field.target_field
+        if isinstance(field, models.BooleanField):
+            column_type = pa.bool_()
+        elif isinstance(field, (models.AutoField, models.IntegerField)):
+            column_type = pa.int64()
+        elif isinstance(field, models.FloatField):
+            column_type = pa.float64()
+        elif isinstance(field, models.DecimalField):
+            column_type = pa.decimal128(field.max_digits, field.decimal_places)
+        elif isinstance(field, models.DateTimeField):
+            column_type = pa.timestamp('us', tz='UTC')
+        elif isinstance(field, models.DateField):
+            column_type = pa.date32()
+        else:
+            column_type = pa.string()
+        columns.append(pa.field(name, column_type))
+    return pa.schema(columns)
+
+
+def write_parquet(model, path, chunk_size=2000):
+    """
+    Write the rows of a model to a parquet file, one row group per chunk. Needs pyarrow.
+    :return: the number of rows written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('The parquet export needs pyarrow: pip install pyarrow')
+
+    schema = arrow_schema(model)
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_chunks(model, chunk_size):
+            frame = pd.DataFrame.from_records(chunk, columns=schema.names)
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    return rows
@@ -15,5 +15,5 @@ class InvoiceForm(forms.Form):
     start = forms.DateField(label='Start date', widget=forms.TextInput(attrs={'class':'datepicker'}))
     end = forms.DateField(label='End date', widget=forms.TextInput(attrs={'class':'datepicker'}))
     delivery_date = forms.DateField(label='Delivery date', widget=forms.TextInput(attrs={'class':'datepicker'}))
-    days = forms.DecimalField(min_value=0, decimal_places=2)
+    days = forms.DecimalField(min_value=0, decimal_places=2, required=False, help_text='leave empty to invoice the time entries of the period')
     output = forms.ChoiceField(choices=(('html', 'html'), ('pdf', 'pdf')))
@@ -0,0 +1,140 @@
+import json
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from django.utils import timezone
+from .documents import check_parameters, render_html, request_document
+from .models import RenderJob
+from .rendering import html_to_pdf
+
+
+def submit(kind, parameters):
+    """
+    Queue the rendering of a document, see documents.request_document for the kinds and parameters. Raises
+    ValueError for parameters the document can't be built from.
+    """
+    check_parameters(kind, parameters)
+    return RenderJob.objects.create(kind=kind, parameters=json.dumps(parameters, sort_keys=True))
+
+
+def requeue_stale(stale_after):
+    """
+    Queue the jobs that have been running for longer than `stale_after` (a timedelta) again: their worker crashed or
+    was killed before it could finish them
+    :return: the number of jobs queued again
+    """
+    return RenderJob.objects.filter(status='running', started_at__lt=timezone.now() - stale_after)\
+        .update(status='queued', started_at=None)
+
+
+def claim(limit):
+    """
+    Mark up to `limit` queued jobs as running and return them. A job is only claimed if it is still queued when it
+    is updated, so several workers can share the queue.
+    """
+    claimed = []
+    for job in RenderJob.objects.filter(status='queued').order_by('created_at').defer('pdf')[:limit]:
+        started_at = timezone.now()
+        if RenderJob.objects.filter(pk=job.pk, status='queued').update(status='running', started_at=started_at):
+            job.status = 'running'
+            job.started_at = started_at
+            claimed.append(job)
+    return claimed
+
+
+def requeue(job):
+    RenderJob.objects.filter(pk=job.pk).update(status='queued', started_at=None)
+
+
+def finish(job, pdf=None, error=None):
+    job.status = 'failed' if error else 'done'
+    job.pdf = pdf
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'pdf', 'error', 'filename', 'finished_at'])
+
+
+class Worker(object):
+    """
+    Runs queued render jobs: the html is rendered in this process (it needs the database), the conversion to pdf is
+    done by a pool of `processes` processes. New jobs are claimed whenever a process is free. Jobs that are running
+    for longer than `stale_after` are taken to be lost by a crashed worker, and are run again.
+
+    When a pool process dies (out of memory, a crash in WeasyPrint) the pool is replaced and the jobs it was running
+    are queued again. A job that was running in `max_crashes` broken pools fails.
+    """
+    def __init__(self, processes=2, poll_interval=1.0, stale_after=timedelta(minutes=10), max_crashes=2):
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_crashes = max_crashes
+        self.completed = 0
+        self.crashes = {}  # job id: number of broken pools the job was running in
+
+    def start(self, pool, running):
+        """
+        Submit new jobs to the pool while it has free processes
+        :return: False if the pool is broken
+        """
+        requeue_stale(self.stale_after)
+        for job in claim(self.processes - len(running)):
+            try:
+                document = request_document(job.kind, json.loads(job.parameters))
+                job.filename = document.filename
+                running[pool.submit(html_to_pdf, render_html(document))] = job
+            except BrokenProcessPool:
+                requeue(job)
+                return False
+            except Exception as ex:
+                finish(job, error=repr(ex))
+                self.completed += 1
+        return True
+
+    def collect(self, futures, running):
+        """
+        Finish the jobs of done futures
+        :return: False if the pool broke while running one of them
+        """
+        intact = True
+        for future in futures:
+            job = running.pop(future)
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                intact = False
+                self.crashes[job.pk] = self.crashes.get(job.pk, 0) + 1
+                if self.crashes[job.pk] < self.max_crashes:
+                    requeue(job)
+                    continue
+            if error:
+                finish(job, error=repr(error))
+            else:
+                finish(job, pdf=future.result())
+            self.completed += 1
+        return intact
+
+    def run(self, once=False):
+        """
+        Process jobs until interrupted, or (once=True) until the queue is empty
+        """
+        running = {}
+        pool = ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            while True:
+                intact = self.start(pool, running)
+                if intact and running:
+                    done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    intact = self.collect(done, running)
+                elif intact and once:
+                    break
+                elif intact:
+                    time.sleep(self.poll_interval)
+                if not intact:
+                    # a broken pool fails all its futures, collect them before it is replaced
+                    pool.shutdown()
+                    self.collect(list(running), running)
+                    pool = ProcessPoolExecutor(max_workers=self.processes)
+        finally:
+            pool.shutdown()
+        return self.completed
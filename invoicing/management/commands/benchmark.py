@@ -0,0 +1,165 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from collections import defaultdict
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.template import loader
+from invoicing.models import Client, Profile, Project, TimeEntry
+from invoicing.rendering import STYLESHEET, html_to_pdf
+from invoicing.timesheet import daily_durations, weekly_calendar
+
+
+def legacy_entries_by_week(entries, start_str, end_str):
+    """
+    The per-day loop display_timesheet used before the timesheet module existed, kept as a reference.
+    """
+    entries_by_week_dict = defaultdict(dict)
+    for day in pd.date_range(start=start_str, end=end_str, tz="UTC"):
+        duration = entries[(entries['start'] >= day) & (entries['start'] <= day + timedelta(days=1))]['duration'].sum()
+        weeknr = str(day.isocalendar()[0]) + '_' + '{:02}'.format(day.isocalendar()[1])
+        weekday = ['', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'][day.isocalendar()[2]]
+        entries_by_week_dict[weeknr][weekday] = {'date': day.strftime('%d-%m'), 'duration': duration}
+    return [entries_by_week_dict[x] for x in sorted(entries_by_week_dict.keys())]
+
+
+def vectorized_entries_by_week(entries, start_str, end_str):
+    return weekly_calendar(daily_durations(entries, start_str, end_str))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark report building blocks on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['timesheet', 'pdf', 'frame'])
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+        parser.add_argument('--days', type=int, default=365, help='length of the reported period')
+        parser.add_argument('--repeat', type=int, default=3, help='the best of this many runs is reported')
+        parser.add_argument('--documents', type=int, default=20, help='number of pdfs rendered per run')
+
+    def synthetic_entries(self, size, start, days):
+        """
+        Time entries spread over the period, all starting during office hours so that the legacy
+        midnight double-counting does not affect the comparison.
+        """
+        rng = np.random.RandomState(42)
+        offsets = rng.randint(0, days, size) * 86400 + rng.randint(8 * 3600, 18 * 3600, size)
+        return pd.DataFrame({
+            'start': pd.Timestamp(start, tz='UTC') + pd.to_timedelta(offsets, unit='s'),
+            'duration': rng.randint(1, 17, size) / 4.0,
+        })
+
+    def time(self, func, *args):
+        best = None
+        result = None
+        for _ in range(self.repeat):
+            t0 = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def benchmark_timesheet(self, sizes, days):
+        start = pd.Timestamp('2017-01-01')
+        start_str = start.strftime('%Y-%m-%d')
+        end_str = (start + timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        self.stdout.write('entries\tloop (s)\tvectorized (s)\tspeedup')
+        for size in sizes:
+            entries = self.synthetic_entries(size, start, days)
+            loop_time, expected = self.time(legacy_entries_by_week, entries, start_str, end_str)
+            vectorized_time, result = self.time(vectorized_entries_by_week, entries, start_str, end_str)
+            if len(expected) != len(result) or any(
+                    not np.isclose(expected_week[day]['duration'], week[day]['duration'])
+                    for expected_week, week in zip(expected, result) for day in expected_week):
+                raise CommandError(f'Results differ for {size} entries')
+            self.stdout.write(f'{size}\t{loop_time:.4f}\t{vectorized_time:.4f}\t{loop_time / vectorized_time:.1f}x')
+
+    def benchmark_pdf(self, documents, days):
+        """
+        Per-document render time of a calendar timesheet, parsing the stylesheet on every render versus reusing the
+        stylesheet and font configuration of the rendering module
+        """
+        from weasyprint import HTML  # only needed (and installed) to render pdfs
+
+        start = pd.Timestamp('2017-01-01')
+        entries = self.synthetic_entries(10 * days, start, days)
+        end = start + timedelta(days=days - 1)
+        end_str = end.strftime('%Y-%m-%d')
+        context = {
+            'client': {'name': 'Client'},
+            'user': {'invoice_name': 'Me'},
+            'start': start.strftime('%d-%m-%Y'),
+            'end': end.strftime('%d-%m-%Y'),
+            'entries_by_week': vectorized_entries_by_week(entries, start.strftime('%Y-%m-%d'), end_str),
+            'total': '{0:.1f}'.format(entries['duration'].sum() / 8.0),
+        }
+        content = loader.render_to_string('calendar_timesheet.html', context)
+
+        def parse_per_render():
+            for _ in range(documents):
+                HTML(string=content).write_pdf(stylesheets=[STYLESHEET])
+
+        def reuse_parsed():
+            for _ in range(documents):
+                html_to_pdf(content)
+
+        html_to_pdf(content)  # parse the stylesheet once, as a running process would have done already
+        per_render_time, _ = self.time(parse_per_render)
+        reused_time, _ = self.time(reuse_parsed)
+        self.stdout.write('parse per render (ms/document)\treuse parsed (ms/document)\tsaving (ms/document)')
+        per_render_ms = 1000 * per_render_time / documents
+        reused_ms = 1000 * reused_time / documents
+        self.stdout.write(f'{per_render_ms:.1f}\t{reused_ms:.1f}\t{per_render_ms - reused_ms:.1f}')
+
+    def measure(self, func):
+        """
+        :return: the frame returned by func, its size and the peak memory allocated while building it (bytes)
+        """
+        tracemalloc.start()
+        frame = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return frame, frame.memory_usage(deep=True).sum(), peak
+
+    def benchmark_frame(self, sizes, days):
+        """
+        Memory used by the time entries DataFrame of get_queryset_df versus get_frame, per million rows. Synthetic
+        entries are inserted in a transaction that is rolled back afterwards.
+        """
+        start = pd.Timestamp('2017-01-01')
+        columns = ['project_id', 'start', 'duration', 'duration_unit', 'billable']
+        self.stdout.write('entries\tget_queryset_df frame (MB/M rows)\tpeak (MB/M rows)\t'
+                          'get_frame frame (MB/M rows)\tpeak (MB/M rows)')
+        for size in sizes:
+            with transaction.atomic():
+                client = Client.objects.create(name='benchmark', VAT_number='benchmark')
+                user = Profile.objects.create(user=User.objects.create(username='benchmark'), bank_account='benchmark',
+                                              phone='benchmark', VAT_number='benchmark')
+                project = Project.objects.create(client=client, user=user, name='benchmark', rate=0, vat_rate=0)
+                entries = self.synthetic_entries(size, start, days)
+                TimeEntry.objects.bulk_create(
+                    (TimeEntry(project=project, start=entry_start, duration=duration, togglId=f'benchmark-{i}')
+                     for i, (entry_start, duration) in enumerate(zip(entries['start'], entries['duration']))),
+                    batch_size=500)
+                del entries
+                _, legacy_size, legacy_peak = self.measure(
+                    lambda: TimeEntry.objects.get_queryset_df(project=project)[columns])
+                _, frame_size, frame_peak = self.measure(
+                    lambda: TimeEntry.objects.get_frame(columns, project=project))
+                transaction.set_rollback(True)
+            per_million = 1e6 / size / 1024 / 1024
+            self.stdout.write(f'{size}\t{legacy_size * per_million:.1f}\t{legacy_peak * per_million:.1f}\t'
+                              f'{frame_size * per_million:.1f}\t{frame_peak * per_million:.1f}')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        if options['target'] == 'timesheet':
+            self.benchmark_timesheet(options['sizes'], options['days'])
+        elif options['target'] == 'pdf':
+            self.benchmark_pdf(options['documents'], options['days'])
+        elif options['target'] == 'frame':
+            self.benchmark_frame(options['sizes'], options['days'])
@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from invoicing.export import EXPORTS, iter_csv, write_parquet
+
+
+class Command(BaseCommand):
+    help = 'Export all time entries, invoices or invoice items to csv or parquet, a chunk of rows at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+        parser.add_argument('--output', type=str, help='file to write to, csv is written to stdout by default')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='number of rows fetched per query')
+
+    def handle(self, *args, **options):
+        model = EXPORTS[options['model']]
+        if options['format'] == 'parquet':
+            if not options['output']:
+                raise CommandError('--output is required for the parquet format')
+            try:
+                rows = write_parquet(model, options['output'], options['chunk_size'])
+            except RuntimeError as ex:
+                raise CommandError(str(ex))
+            print(f'{rows} rows written to {options["output"]}', file=sys.stderr)
+        else:
+            output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+            try:
+                for lines in iter_csv(model, options['chunk_size']):
+                    output.write(lines)
+            finally:
+                if options['output']:
+                    output.close()
@@ -1,13 +1,21 @@
 import numpy as np
 import datetime
 from django.core.management.base import BaseCommand, CommandError
+from invoicing.planning import business_calendar
 
 
 class Command(BaseCommand):
     help = 'Get a count of all remaning business days this year'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--calendar', type=str, help='name of the work calendar, defaults to WORK_CALENDAR')
+
     def handle(self, *args, **options):
+        try:
+            calendar = business_calendar(options['calendar'])
+        except ValueError as ex:
+            raise CommandError(str(ex))
         now = datetime.date.today()
-        end_of_year = datetime.date(now.year, 12, 31)
-        remaining_days = np.busday_count(now, end_of_year)
-        print(remaining_days)
+        next_year = datetime.date(now.year + 1, 1, 1)
+        remaining_days = np.busday_count(now, next_year, busdaycal=calendar)
+        self.stdout.write(str(remaining_days))
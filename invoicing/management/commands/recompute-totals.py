@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from invoicing import reporting
+from invoicing.models import TOTAL_FIELDS, CreditNote, Invoice
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored totals of all invoices and creditnotes'
+
+    def recompute(self, queryset):
+        """
+        :return: number of documents whose totals changed
+        """
+        changed = 0
+        for document in queryset:
+            stored = [getattr(document, field) for field in TOTAL_FIELDS]
+            document.compute_totals()
+            if [getattr(document, field) for field in TOTAL_FIELDS] != stored:
+                # update instead of save: saving would compute the totals again and fire the signals
+                type(document).objects.filter(pk=document.pk).update(
+                    **{field: getattr(document, field) for field in TOTAL_FIELDS})
+                changed += 1
+        return changed
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            invoices = self.recompute(Invoice.objects.select_related('project').prefetch_related('invoiceitem_set'))
+            creditnotes = self.recompute(CreditNote.objects.all())
+        if invoices or creditnotes:
+            reporting.invalidate()
+        self.stdout.write(f'invoices updated: {invoices}, creditnotes updated: {creditnotes}')
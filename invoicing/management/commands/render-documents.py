@@ -0,0 +1,35 @@
+import time
+
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from invoicing.documents import render_documents, select_documents
+
+
+class Command(BaseCommand):
+    help = 'Render invoices and creditnotes to pdf in parallel, into a directory or a zip file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--invoices', nargs='+', type=int, default=[], help='invoice ids')
+        parser.add_argument('--creditnotes', nargs='+', type=int, default=[], help='creditnote ids')
+        parser.add_argument('--month', type=str, help='render all invoices dated in this month (yyyy-mm)')
+        parser.add_argument('--output', type=str, default='.', help='output directory, or a file name ending on .zip')
+        parser.add_argument('--workers', type=int, default=None, help='number of processes, defaults to the number of CPUs')
+
+    def handle(self, *args, **options):
+        month = None
+        if options['month']:
+            month_start = datetime.strptime(options['month'], '%Y-%m')
+            month = (month_start.year, month_start.month)
+        documents = select_documents(options['invoices'], options['creditnotes'], month)
+        if not documents:
+            raise CommandError('No documents selected')
+
+        t0 = time.perf_counter()
+        report = render_documents(documents, options['output'], workers=options['workers'])
+        elapsed = time.perf_counter() - t0
+
+        print('document\tseconds\tbytes')
+        for document in report:
+            print('{filename}\t{seconds:.3f}\t{bytes}'.format(**document))
+        render_time = sum(x['seconds'] for x in report)
+        print(f'{len(report)} documents in {elapsed:.2f}s (sum of render times: {render_time:.2f}s)')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from invoicing.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = 'Render queued timesheet, invoice and creditnote pdfs in the background'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='number of pdfs rendered in parallel')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds between checks for new jobs')
+        parser.add_argument('--once', action='store_true', help='stop when the queue is empty')
+
+    def handle(self, *args, **options):
+        worker = Worker(processes=options['processes'], poll_interval=options['poll_interval'])
+        completed = worker.run(once=options['once'])
+        print('{} jobs completed'.format(completed))
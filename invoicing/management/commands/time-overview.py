@@ -1,44 +1,49 @@
-import numpy as np
-import pandas as pd
+from datetime import datetime
 from django.core.management.base import BaseCommand, CommandError
-from invoicing.models import Project, TimeEntry
+from django.utils.timezone import utc
+from invoicing.models import TimeEntry
+
+PERIODS = {
+    'year': ['year'],
+    'month': ['year', 'month'],
+    'week': ['week'],
+}
 
 
 class Command(BaseCommand):
     help = 'Get an overview of days spent on different projects'
 
-    def entries_to_df(self, entries):
-        df = pd.DataFrame(data=entries)
-        return df
-
-    def convert_durations_to_hour(self, entries_df):
-        if {'hours'} == set(entries_df['duration_unit'].unique()):
-            entries_df['duration_hour'] = entries_df['duration']
-        else:
-            issues = entries_df[entries_df['duration_unit'] != 'hours']
-            raise RuntimeError(f'Not all entries have duration_unit = hours. Others found: {set(issues["duration_unit"].unique())}')
-
-
-    def entries_total_time_by_year(self, entries_df, unit='day'):
-        entries_df['year'] = entries_df['start'].dt.year
-        grouped = entries_df[['year', 'duration_hour']].groupby('year')
-        if unit == 'day':
-            return grouped.aggregate(lambda x: np.sum(x) / 8.0).rename(columns={'duration_hour': 'total_days'})
-        else:
-            raise RuntimeError(f'Not supported: unit {unit}')
-
-    def load_projects(self):
-        return Project.objects.all()
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=sorted(PERIODS), default='year', help='period to add up the time by')
+        parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table')
+        parser.add_argument('--since', type=str, help='only count time entries from this date on (yyyy-mm-dd)')
+        parser.add_argument('--include-non-billable', action='store_true', help='also count non-billable time')
+
+    def entries_total_days(self, by, since=None, include_non_billable=False):
+        """
+        Days (of 8 hours) spent per project and period, with one grouped query
+        """
+        entries = TimeEntry.objects.all() if include_non_billable else TimeEntry.objects.billable()
+        if since:
+            entries = entries.filter(start__gte=since)
+        totals = entries.totals_by('project_name', *PERIODS[by])
+        totals['duration'] /= 8.0
+        return totals.rename(columns={'project_name': 'project', 'duration': 'total_days'})
 
     def handle(self, *args, **options):
-        projects = Project.objects.all()
-
-        for project in projects:
-            time_entries_df = self.entries_to_df([x.to_dict() for x in project.timeentry_set.all()])
-            if len(time_entries_df) > 0:
-                self.convert_durations_to_hour(time_entries_df)
-                time_by_year = self.entries_total_time_by_year(time_entries_df)
-                print(f"\n{project.name}\n===============""")
-                print(time_by_year.to_csv(sep='\t'))
-            else:
-                print('-')
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').replace(tzinfo=utc)
+            except ValueError as ex:
+                raise CommandError(str(ex))
+        totals = self.entries_total_days(options['by'], since, options['include_non_billable'])
+
+        if options['format'] == 'csv':
+            self.stdout.write(totals.to_csv(sep='\t', index=False, float_format='%.2f'), ending='')
+        elif options['format'] == 'json':
+            self.stdout.write(totals.to_json(orient='records'))
+        elif len(totals) > 0:
+            self.stdout.write(totals.to_string(index=False, float_format='%.2f'))
+        else:
+            self.stdout.write('-')
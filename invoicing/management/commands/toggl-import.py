@@ -1,21 +1,32 @@
-import os
-import pandas as pd
-
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import IntegrityError
+from django.utils import timezone
 from jinja2 import Template
 from utils.TogglPy import Toggl
-from invoicing.models import Project, TimeEntry
-from dateutil.parser import parse
+from invoicing.models import SyncState
+from invoicing.toggl import CHUNKS, Backfill, TimeEntryImporter, sync_since_last
+
 
 class Command(BaseCommand):
     help = 'Retrieve time entries for a given project and period'
 
     def add_arguments(self, parser):
-        parser.add_argument('start_date', type=str)
-        parser.add_argument('end_date', type=str)
+        parser.add_argument('start_date', type=str, nargs='?')
+        parser.add_argument('end_date', type=str, nargs='?')
+        parser.add_argument('--update', action='store_true',
+                            help='update start and duration of entries that were imported before')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workspace', type=int, default=getattr(settings, 'TOGGL_WORKSPACE_ID', None),
+                            help='toggl workspace id, defaults to TOGGL_WORKSPACE_ID or your first workspace')
+        parser.add_argument('--backfill', action='store_true',
+                            help='import the period in windows fetched concurrently, resuming an interrupted backfill')
+        parser.add_argument('--chunk', choices=sorted(CHUNKS), default='month', help='backfill window size')
+        parser.add_argument('--workers', type=int, default=4, help='number of windows fetched concurrently')
+        parser.add_argument('--rate-limit', type=float, default=None, help='maximum number of toggl requests per second')
+        parser.add_argument('--since-last', action='store_true',
+                            help='only import entries created, updated or deleted since the previous --since-last run. '
+                                 'The first run imports the given period and sets the starting point.')
 
     def check_entries(self, entries_df):
         entries_df['start_date'] = entries_df['start'].str[:10]
@@ -80,40 +91,35 @@ class Command(BaseCommand):
         print(invoice_html)
 
     def handle(self, *args, **options):
+        # create a Toggl object and set our API key
+        toggl = Toggl(pool_maxsize=options['workers'], rate_limit=options['rate_limit'])
+        toggl.setAPIKey(settings.TOGGL_API_KEY)
+
+        workspace_id = options['workspace'] or toggl.getWorkspaces()[0]['id']
+        importer = TimeEntryImporter(update=options['update'] or options['since_last'], batch_size=options['batch_size'])
+        if options['since_last'] and SyncState.objects.filter(workspace_id=workspace_id).exists():
+            state = sync_since_last(toggl, workspace_id, importer)
+            print(importer.summary())
+            print('synced up to {}'.format(state.last_synced_at.isoformat()))
+            return
+
+        if not options['start_date'] or not options['end_date']:
+            raise CommandError('start_date and end_date are required for the first import of workspace {}'.format(workspace_id))
         start_str = options['start_date']
         start = datetime.strptime(start_str, '%Y-%m-%d')
         end_str = options['end_date']
         end = datetime.strptime(end_str, '%Y-%m-%d')
 
-        # create a Toggl object and set our API key
-        toggl = Toggl()
-        toggl.setAPIKey(settings.TOGGL_API_KEY)
+        synced_at = timezone.now()
+        if options['backfill']:
+            backfill = Backfill(toggl, workspace_id, importer, workers=options['workers'])
+            windows = backfill.run(start.date(), end.date(), chunk=options['chunk'])
+            print('{} windows imported'.format(windows))
+        else:
+            # the detailed report includes the last day, the end date of this command is exclusive
+            entries = toggl.iterTimeEntries(start, end - timedelta(days=1), workspace_id)
+            importer.import_entries(entries)
+        print(importer.summary())
+        if options['since_last']:
+            SyncState.objects.create(workspace_id=workspace_id, last_synced_at=synced_at)
 
-        entries = toggl.getTimeEntries(start, end)
-        projects_hash = {}
-        for entry in entries:
-            print(entry)
-            if not 'pid' in entry.keys():
-                raise RuntimeError('entry has no project: {}'.format(entry))
-            if projects_hash.get(entry['pid']):
-                project = projects_hash.get(entry['pid'])
-            else:
-                try:
-                    project = Project.objects.get(togglId=entry['pid'])
-                    projects_hash[entry['pid']] = project
-                except Project.DoesNotExist:
-                    print('unknown project: {}'.format(entry['pid']))
-                    continue
-            try:
-                entry_start = parse(entry['start'])
-                duration = entry['duration'] / 3600.0
-                db_entry = TimeEntry(
-                    project=project,
-                    start=entry_start,
-                    duration=duration,
-                    togglId=entry['id']
-                )
-                db_entry.save()
-            except IntegrityError as ex:
-                print(ex)
-                pass
\ No newline at end of file
@@ -1,127 +1,61 @@
-import os
-import pandas as pd
-
-from datetime import datetime
+from datetime import date, datetime
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
-from django.db import IntegrityError
-from jinja2 import Template
-from utils.TogglPy import Toggl
-from invoicing.models import Project, TimeEntry
-from dateutil.parser import parse
+from invoicing.models import Project
+from invoicing.planning import business_calendar, default_shares, forecast
+
 
 class Command(BaseCommand):
-    help = 'Retrieve time entries for a given project and period'
+    help = 'Forecast the days and revenue per project for the rest of the year, or any other period'
 
     def add_arguments(self, parser):
-        parser.add_argument('start_date', type=str)
-        parser.add_argument('end_date', type=str)
-
-
-    def entries_to_df(self, entries):
-        df = pd.DataFrame(entries)
-        return df
-
-    def load_projects(self):
-        return Project.objects.all()
-
-    def check_entries(self, entries_df):
-        entries_df['start_date'] = entries_df['start'].str[:10]
-        entries_df['stop_date'] = entries_df['stop'].str[:10]
-        entries_df['duration_h'] = entries_df['duration'] / (60.0 * 60)
-        incorrect_date_entries = entries_df[entries_df['start_date'] != entries_df['stop_date']]
-        too_long_entries = entries_df[entries_df['duration_h'] > 12]
-
-        if len(incorrect_date_entries) > 0 or len(too_long_entries) > 0:
-            print('incorrect date entries')
-            print(incorrect_date_entries)
-            print('too long entries')
-            print(too_long_entries)
-            raise RuntimeError('incorrect time entries found')
-
-    def print_timesheet(self, entries_df):
-        print('==> TIMESHEET DATA <==\n')
-        print(entries_df[['start_date', 'duration_h', 'description']].to_csv(sep='\t'))
-
-    def print_invoice(self, entries, project):
-        days_worked = sum(map(lambda x: x['duration'] / (60.0 * 60 * 8), entries))
-        print('==> INVOICE DATA <==')
-        print('''
-        project name: {project}
-        client name: {client_name}
-        client address:
-        {client_addr1}
-        {client_addr2}
-        client VAT number: {client_VAT}
-        daily rate: {rate}
-
-        total days: {days}
-        total: {total}
-        total (VAT incl): {total_vat}
-        '''.format(
-            project=project['project'],
-            client_name=project['billing']['name'],
-            client_addr1=project['billing']['address_line_1'],
-            client_addr2=project['billing']['address_line_2'],
-            client_VAT=project['billing']['VAT'],
-            rate=project['rate'],
-            days=days_worked,
-            total=(days_worked * project['rate']),
-            total_vat=(days_worked * project['rate'] * 1.21)
-        ))
-
-    def render_invoice(self, entries, project):
-        days_worked = sum(map(lambda x: x['duration'] / (60.0 * 60 * 8), entries))
-        template = Template(open('templates/invoice.html').read())
-        invoice_html = template.render(
-            client=project['billing'],
-            invoice_number=1,
-            invoice_date='2017-01-02',
-            invoice_delivery_date='2017-01-02',
-            project_description='test description',
-            description='work done',
-            nr_of_days=days_worked,
-            rate=project['rate'],
-            total=(days_worked * project['rate']),
-            total_vat=(days_worked * project['rate'] * 1.21)
-        )
-        print(invoice_html)
+        parser.add_argument('--start', type=str, help='start of the plan (yyyy-mm-dd), defaults to today')
+        parser.add_argument('--end', type=str, help='end of the plan (yyyy-mm-dd), defaults to the end of the start year')
+        parser.add_argument('--share', action='append', default=[], metavar='PROJECT=FRACTION',
+                            help='fraction of the free days planned for a project, by default the free days are '
+                                 'shared like the billable time of the last --history days')
+        parser.add_argument('--calendar', type=str, help='name of the work calendar, defaults to WORK_CALENDAR')
+        parser.add_argument('--history', type=int, default=90, help='number of days the default shares are based on')
+        parser.add_argument('--by', choices=['month', 'year'], default='month')
+        parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table')
+
+    def parse_shares(self, shares):
+        """
+        :return: {project id: share} for a list of 'project name=fraction' strings
+        """
+        fractions = {}
+        for share in shares:
+            name, _, fraction = share.rpartition('=')
+            try:
+                fractions[name] = float(fraction)
+            except ValueError:
+                raise CommandError(f'Invalid share: {share}')
+        projects = dict(Project.objects.filter(name__in=fractions).values_list('name', 'pk'))
+        unknown = set(fractions) - set(projects)
+        if unknown:
+            raise CommandError(f'Unknown projects: {", ".join(sorted(unknown))}')
+        return {projects[name]: fraction for name, fraction in fractions.items()}
 
     def handle(self, *args, **options):
-        start_str = options['start_date']
-        start = datetime.strptime(start_str, '%Y-%m-%d')
-        end_str = options['end_date']
-        end = datetime.strptime(end_str, '%Y-%m-%d')
-
-        # create a Toggl object and set our API key
-        toggl = Toggl()
-        toggl.setAPIKey(settings.TOGGL_API_KEY)
-
-        entries = toggl.getTimeEntries(start, end)
-        projects_hash = {}
-        for entry in entries:
-            print(entry)
-            if not 'pid' in entry.keys():
-                raise RuntimeError('entry has no project: {}'.format(entry))
-            if projects_hash.get(entry['pid']):
-                project = projects_hash.get(entry['pid'])
-            else:
-                try:
-                    project = Project.objects.get(togglId=entry['pid'])
-                    projects_hash[entry['pid']] = project
-                except Project.DoesNotExist:
-                    print('unknown project: {}'.format(entry['pid']))
-                    continue
-            try:
-                entry_start = parse(entry['start'])
-                duration = entry['duration'] / 3600.0
-                db_entry = TimeEntry(
-                    project=project,
-                    start=entry_start,
-                    duration=duration,
-                    togglId=entry['id']
-                )
-                db_entry.save()
-            except IntegrityError as ex:
-                print(ex)
-                pass
\ No newline at end of file
+        try:
+            start = datetime.strptime(options['start'], '%Y-%m-%d').date() if options['start'] else date.today()
+            end = datetime.strptime(options['end'], '%Y-%m-%d').date() if options['end'] else date(start.year, 12, 31)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        shares = self.parse_shares(options['share']) if options['share'] else default_shares(start, options['history'])
+        try:
+            plan = forecast(start, end, shares, business_calendar(options['calendar']))
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        if options['by'] == 'year':
+            plan = plan.assign(month=plan['month'].str[:4]).rename(columns={'month': 'year'})\
+                .groupby(['project', 'year'], as_index=False, sort=False).sum()
+
+        if options['format'] == 'csv':
+            self.stdout.write(plan.to_csv(sep='\t', index=False, float_format='%.2f'), ending='')
+        elif options['format'] == 'json':
+            self.stdout.write(plan.to_json(orient='records'))
+        elif len(plan) > 0:
+            self.stdout.write(plan.to_string(index=False, float_format='%.2f'))
+            self.stdout.write(f'total: {plan["planned_days"].sum():.2f} days, {plan["revenue"].sum():.2f} revenue')
+        else:
+            self.stdout.write('-')
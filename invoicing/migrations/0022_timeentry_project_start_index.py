@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+COVERING_INDEX = 'timeentry_project_start_cov'
+
+
+def supports_covering_index(connection):
+    # INCLUDE columns are supported as of PostgreSQL 11
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def create_covering_index(apps, schema_editor):
+    if supports_covering_index(schema_editor.connection):
+        schema_editor.execute(
+            'CREATE INDEX {} ON invoicing_timeentry (project_id, start) INCLUDE (duration, billable)'.format(COVERING_INDEX)
+        )
+
+
+def drop_covering_index(apps, schema_editor):
+    if supports_covering_index(schema_editor.connection):
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(COVERING_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0021_profile_bic_account_code'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='timeentry',
+            index=models.Index(fields=['project', 'start'], name='timeentry_project_start_idx'),
+        ),
+        migrations.RunPython(create_covering_index, drop_covering_index),
+    ]
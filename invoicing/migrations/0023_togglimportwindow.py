@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0022_timeentry_project_start_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TogglImportWindow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('workspace_id', models.IntegerField()),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('entries', models.IntegerField(default=0)),
+                ('imported_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='togglimportwindow',
+            unique_together=set([('workspace_id', 'start', 'end')]),
+        ),
+    ]
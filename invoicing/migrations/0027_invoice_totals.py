@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:15
+from __future__ import unicode_literals
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def to_cents(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+def compute_totals(apps, schema_editor):
+    """
+    Fill in the totals of the existing invoices and creditnotes, as Invoice.compute_totals and
+    CreditNote.compute_totals do (the historical models don't have these methods)
+    """
+    Invoice = apps.get_model('invoicing', 'Invoice')
+    CreditNote = apps.get_model('invoicing', 'CreditNote')
+    for invoice in Invoice.objects.select_related('project').prefetch_related('invoiceitem_set'):
+        vat_rate = Decimal(str(invoice.vat_rate))
+        total = Decimal(str(invoice.days)) * invoice.project.rate
+        vat = total * vat_rate
+        for item in invoice.invoiceitem_set.all():
+            total += item.price
+            vat += item.price * (item.vat_rate if item.vat_rate else vat_rate)
+        Invoice.objects.filter(pk=invoice.pk).update(total_excl_vat=to_cents(total), total_vat=to_cents(vat),
+                                                     total_incl_vat=to_cents(total) + to_cents(vat))
+    for creditnote in CreditNote.objects.all():
+        total = to_cents(creditnote.amount)
+        vat = to_cents(Decimal(str(creditnote.amount)) * Decimal(str(creditnote.vat_rate)))
+        CreditNote.objects.filter(pk=creditnote.pk).update(total_excl_vat=total, total_vat=vat,
+                                                           total_incl_vat=total + vat)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0026_numbersequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='creditnote',
+            name='total_excl_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='creditnote',
+            name='total_incl_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='creditnote',
+            name='total_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='total_excl_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='total_incl_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='total_vat',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Func
+from django.db.models.functions import Cast
+
+SECONDS_PER_UNIT = {
+    'days': 8 * 3600,
+    'hours': 3600,
+    'minutes': 60,
+}
+
+COVERING_INDEX = 'timeentry_project_start_cov'
+
+
+def supports_covering_index(connection):
+    # INCLUDE columns are supported as of PostgreSQL 11
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def normalize_durations(apps, schema_editor):
+    TimeEntry = apps.get_model('invoicing', 'TimeEntry')
+    for unit, seconds in SECONDS_PER_UNIT.items():
+        TimeEntry.objects.filter(duration_unit=unit).update(
+            duration_seconds=Cast(Func(F('duration') * seconds, function='ROUND'), models.IntegerField()))
+
+
+def include_duration_seconds(apps, schema_editor):
+    if supports_covering_index(schema_editor.connection):
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(COVERING_INDEX))
+        schema_editor.execute(
+            'CREATE INDEX {} ON invoicing_timeentry (project_id, start) INCLUDE (duration_seconds, billable)'.format(COVERING_INDEX)
+        )
+
+
+def include_duration(apps, schema_editor):
+    if supports_covering_index(schema_editor.connection):
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(COVERING_INDEX))
+        schema_editor.execute(
+            'CREATE INDEX {} ON invoicing_timeentry (project_id, start) INCLUDE (duration, billable)'.format(COVERING_INDEX)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0028_invoice_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeentry',
+            name='duration_seconds',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(normalize_durations, migrations.RunPython.noop),
+        # the reports add up duration_seconds now, so that is the column the covering index should hold
+        migrations.RunPython(include_duration_seconds, include_duration),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+BILLABLE_INDEX = 'timeentry_billable_project_start_idx'
+
+# partial indexes can't be declared in the model's Meta before Django 2.2
+BILLABLE_CONDITION = {
+    'postgresql': 'billable',
+    'sqlite': 'billable = 1',
+}
+
+
+def create_billable_index(apps, schema_editor):
+    condition = BILLABLE_CONDITION.get(schema_editor.connection.vendor)
+    if condition:
+        schema_editor.execute(
+            'CREATE INDEX {} ON invoicing_timeentry (project_id, start) WHERE {}'.format(BILLABLE_INDEX, condition)
+        )
+
+
+def drop_billable_index(apps, schema_editor):
+    if schema_editor.connection.vendor in BILLABLE_CONDITION:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(BILLABLE_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0031_timeentry_invoice'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_billable_index, drop_billable_index),
+    ]
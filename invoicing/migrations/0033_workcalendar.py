@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0032_timeentry_billable_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('name', models.CharField(blank=True, max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WorkCalendar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('country', models.CharField(blank=True, max_length=2)),
+                ('weekmask', models.CharField(default='1111100', max_length=7)),
+                ('changed_at', models.DateTimeField(editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='holiday',
+            name='calendar',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holidays', to='invoicing.WorkCalendar'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='work_calendar',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='invoicing.WorkCalendar'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='holiday',
+            unique_together=set([('calendar', 'date')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:58
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing', '0034_cachegeneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='country',
+            field=models.CharField(blank=True, help_text='ISO 3166 code, e.g. BE', max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='work_calendar',
+            field=models.ForeignKey(blank=True, help_text='defaults to the calendar of the country', null=True, on_delete=django.db.models.deletion.SET_NULL, to='invoicing.WorkCalendar'),
+        ),
+        migrations.AlterField(
+            model_name='workcalendar',
+            name='country',
+            field=models.CharField(blank=True, help_text='ISO 3166 code, e.g. BE', max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='workcalendar',
+            name='weekmask',
+            field=models.CharField(default='1111100', help_text='working days, Monday first: 1111100 is Monday to Friday', max_length=7, validators=[django.core.validators.RegexValidator('^(?!0{7})[01]{7}$', 'Seven 0s and 1s, at least one working day')]),
+        ),
+    ]
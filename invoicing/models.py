@@ -1,7 +1,17 @@
+import numpy as np
 import pandas as pd
-from datetime import date
+from datetime import date, datetime, time
+from decimal import Decimal
+from itertools import islice
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.validators import RegexValidator
+from django.db import models, transaction
+from django.db.models import ExpressionWrapper, F, Max, Sum
+from django.db.models.functions import Cast, ExtractMonth, ExtractYear, Greatest, TruncDate
+from django.utils import timezone
+from django.utils.timezone import utc
+from pandas.api.types import union_categoricals
 
 
 class Client(models.Model):
@@ -32,11 +42,83 @@ class Profile(models.Model):
     phone = models.CharField(max_length=20, unique=True)
     email = models.EmailField()
     VAT_number = models.CharField(max_length=20, unique=True)
+    country = models.CharField(max_length=2, blank=True, help_text='ISO 3166 code, e.g. BE')
+    work_calendar = models.ForeignKey('WorkCalendar', null=True, blank=True, on_delete=models.SET_NULL,
+                                      help_text='defaults to the calendar of the country')
 
     def __str__(self):
         return self.invoice_name
 
 
+WEEKMASK_VALIDATOR = RegexValidator(r'^(?!0{7})[01]{7}$', 'Seven 0s and 1s, at least one working day')
+
+
+class WorkCalendar(models.Model):
+    """
+    Working days of a country, or of a single user: the days of the week in weekmask (Monday first, '1111100' is Monday
+    to Friday) except the holidays. A profile uses the calendar linked to it, or else the calendar of its country;
+    other reports use the calendar named in the WORK_CALENDAR setting. changed_at is updated whenever the calendar
+    or its holidays change.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    country = models.CharField(max_length=2, blank=True, help_text='ISO 3166 code, e.g. BE')
+    weekmask = models.CharField(max_length=7, default='1111100', validators=[WEEKMASK_VALIDATOR],
+                                help_text='working days, Monday first: 1111100 is Monday to Friday')
+    changed_at = models.DateTimeField(editable=False)
+
+    # numpy busdaycalendars built in this process: {calendar id: (changed_at, busdaycalendar)}
+    _busdaycalendars = {}
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        # also outside of forms: an invalid weekmask would break every timesheet using the calendar
+        WEEKMASK_VALIDATOR(self.weekmask)
+        self.changed_at = timezone.now()
+        super(WorkCalendar, self).save(*args, **kwargs)
+
+    def busdaycalendar(self):
+        """
+        The calendar as a numpy busdaycalendar, the holidays are only loaded when the calendar changed since it was
+        last built in this process
+        """
+        changed_at, calendar = self._busdaycalendars.get(self.pk, (None, None))
+        if changed_at != self.changed_at:
+            holidays = list(self.holidays.values_list('date', flat=True))
+            calendar = np.busdaycalendar(weekmask=self.weekmask, holidays=holidays)
+            WorkCalendar._busdaycalendars[self.pk] = (self.changed_at, calendar)
+        return calendar
+
+    @classmethod
+    def lookup(cls, name=None, profile=None):
+        """
+        The calendar with the given name, or else the calendar of the profile, or else the calendar of the profile's
+        country, or else the calendar named in the WORK_CALENDAR setting. None if there is no such calendar.
+        """
+        if name is None and profile is not None:
+            if profile.work_calendar_id:
+                return profile.work_calendar
+            if profile.country:
+                calendar = cls.objects.filter(country=profile.country).order_by('name').first()
+                if calendar is not None:
+                    return calendar
+        name = name or getattr(settings, 'WORK_CALENDAR', None)
+        return cls.objects.filter(name=name).first() if name else None
+
+
+class Holiday(models.Model):
+    calendar = models.ForeignKey(WorkCalendar, on_delete=models.CASCADE, related_name='holidays')
+    date = models.DateField()
+    name = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        unique_together = ('calendar', 'date')
+
+    def __str__(self):
+        return '{0} {1}'.format(self.date, self.name)
+
+
 class Project(models.Model):
     """
     A user can create one or many projects for a given client. Note that:
@@ -59,29 +141,196 @@ class Project(models.Model):
         return self.name
 
 
-class TimeEntryDFManager(models.Manager):
+def utc_datetime(value):
+    """
+    Dates are taken as midnight UTC, datetimes are returned as they are
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time(tzinfo=utc))
+
+
+class TimeEntryQuerySet(models.QuerySet):
     """
-    Helper manager to get time entries returned as a pandas DataFrame
+    Chainable filters shared by all reports, e.g. TimeEntry.objects.billable().for_project(project).in_range(start,
+    end), and their results as a pandas DataFrame or aggregated by the database
+    """
+    DATE_PARTS = {
+        'year': ExtractYear('start'),
+        'month': ExtractMonth('start'),
+        'day': TruncDate('start'),
+    }
+
+    # column types of as_frame, columns without a type here (togglId) are kept as python objects
+    FRAME_DTYPES = {
+        'id': 'int32',
+        'project_id': 'int32',
+        'start': 'datetime64[ns, UTC]',
+        'duration': 'float32',
+        'duration_seconds': 'int32',
+        'duration_unit': 'category',
+        'billable': 'bool',
+    }
+    FRAME_CHUNK_SIZE = 50000
+
+    def billable(self):
+        """
+        Only billable time entries, served by the partial (project, start) index on billable entries
+        """
+        return self.filter(billable=True)
+
+    def for_project(self, project):
+        return self.filter(project=project)
+
+    def in_range(self, start, end):
+        """
+        Time entries starting from start up to (not including) end, dates are taken as midnight UTC
+        """
+        return self.filter(start__gte=utc_datetime(start), start__lt=utc_datetime(end))
+
+    def as_frame(self, columns=('project_id', 'start', 'duration_seconds')):
+        """
+        The time entries as a DataFrame with only the given columns, typed as in FRAME_DTYPES. Rows are read in
+        chunks that are converted to typed arrays right away, so the python objects of at most one chunk are in
+        memory at the same time.
+        """
+        columns = list(columns)
+        rows = self.values_list(*columns).iterator()
+        chunks = {column: [] for column in columns}
+        chunk = list(islice(rows, self.FRAME_CHUNK_SIZE))
+        while chunk:
+            for column, values in zip(columns, zip(*chunk)):
+                chunks[column].append(self.frame_column(column, values))
+            chunk = list(islice(rows, self.FRAME_CHUNK_SIZE))
+        return pd.DataFrame({column: self.concat_frame_column(column, chunks[column]) for column in columns},
+                            columns=columns)
+
+    def frame_column(self, column, values):
+        dtype = self.FRAME_DTYPES.get(column, object)
+        if dtype == 'datetime64[ns, UTC]':
+            # naive datetimes in UTC, cast explicitly: the default resolution depends on the pandas version
+            return pd.to_datetime(values, utc=True).values.astype('datetime64[ns]')
+        elif dtype == 'category':
+            return pd.Categorical(values)
+        return np.array(values, dtype=dtype)
+
+    def concat_frame_column(self, column, arrays):
+        dtype = self.FRAME_DTYPES.get(column, object)
+        if dtype == 'datetime64[ns, UTC]':
+            values = np.concatenate(arrays) if arrays else np.array([], dtype='datetime64[ns]')
+            return pd.DatetimeIndex(values).tz_localize('UTC')
+        elif dtype == 'category':
+            return union_categoricals(arrays) if arrays else pd.Categorical([])
+        return np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+
+    def daily_totals(self, project, start, end):
+        """
+        Total duration in hours per day (UTC) of the time entries of a project starting in [start, end)
+
+        :return: Series of durations indexed by day, only days with time entries are included
+        """
+        totals = self.for_project(project).in_range(start, end)\
+            .annotate(day=TruncDate('start')).values('day')\
+            .annotate(total=self.hours()).order_by('day').values_list('day', 'total')
+        days, durations = zip(*totals) if totals else ((), ())
+        return pd.Series(durations, index=pd.DatetimeIndex(days).tz_localize('UTC'), dtype=float)
+
+    def hours(self):
+        """
+        Sum of the durations in hours
+        """
+        return ExpressionWrapper(Cast(Sum('duration_seconds'), models.FloatField()) / 3600.0, output_field=models.FloatField())
+
+    def totals_by(self, *keys, **filters):
+        """
+        Total duration in hours of the time entries matching the filters, grouped by one or more of 'project' (id),
+        'project_name', 'year', 'month', 'day' and 'week'. E.g. totals_by('project', 'year') returns a DataFrame
+        with columns project, year and duration. Weeks are ISO weeks ('2017-W01'), they are added up here from the
+        daily totals of the query.
+        """
+        unknown = set(keys) - {'project', 'project_name', 'week'} - set(self.DATE_PARTS)
+        if unknown:
+            raise ValueError(f'Cannot group time entries by {unknown}')
+        query_keys = [key if key != 'week' else 'day' for key in keys]
+        parts = {key: self.DATE_PARTS[key] for key in query_keys if key in self.DATE_PARTS}
+        if 'project_name' in keys:
+            parts['project_name'] = F('project__name')
+        totals = self.filter(**filters).annotate(**parts).values(*query_keys)\
+            .annotate(duration=self.hours()).order_by(*query_keys).values_list(*query_keys, 'duration')
+        frame = pd.DataFrame.from_records(list(totals), columns=query_keys + ['duration'])
+        if 'week' in keys:
+            if len(frame) > 0:
+                iso = pd.to_datetime(frame['day']).dt.isocalendar()
+                frame['week'] = iso['year'].astype(str) + '-W' + iso['week'].map('{:02}'.format)
+                frame = frame.groupby(list(keys), as_index=False, sort=True)['duration'].sum()
+            else:
+                frame = frame.rename(columns={'day': 'week'})
+        return frame
+
+
+class TimeEntryDFManager(models.Manager.from_queryset(TimeEntryQuerySet)):
+    """
+    Helper manager to get time entries returned as a pandas DataFrame, or aggregated by the database
     """
     def get_queryset_df(self, *args, **kwargs):
-        df = pd.DataFrame(list(super(TimeEntryDFManager, self).get_queryset().filter(*args, **kwargs).values()))
+        columns = [field.attname for field in self.model._meta.concrete_fields]
+        rows = super(TimeEntryDFManager, self).get_queryset().filter(*args, **kwargs).values_list(*columns)
+        df = pd.DataFrame.from_records(list(rows), columns=columns)
         return df
 
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Bulk inserts skip save(), normalize the durations here
+        """
+        objs = list(objs)
+        for obj in objs:
+            obj.normalize_duration()
+        return super(TimeEntryDFManager, self).bulk_create(objs, batch_size=batch_size)
+
+    def get_frame(self, columns=('project_id', 'start', 'duration_seconds'), **filters):
+        """
+        The time entries matching the filters as a compactly typed DataFrame, see TimeEntryQuerySet.as_frame
+        """
+        return self.get_queryset().filter(**filters).as_frame(columns)
+
 
 class TimeEntry(models.Model):
     """
-    An amount of time worked on a project. Can be billable or not (although at the current state, the invoicing
-    logic does not take this into account yet)
+    An amount of time worked on a project. Can be billable or not, only billable time is reported in timesheets and
+    invoiced (see TimeEntryQuerySet.billable)
     """
-    billable = models.BooleanField(default=True)  # todo: make sure time entries with billable = False are not included in time sheets and invoices
+    billable = models.BooleanField(default=True)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     start = models.DateTimeField()
     duration = models.FloatField()
-    duration_unit = models.CharField(choices=(('days', 'days'), ('hours', 'hours'), ('minutes', 'minutes')), default='hours', max_length=10)  # todo: current reports can only handle 'hours'
+    duration_unit = models.CharField(choices=(('days', 'days'), ('hours', 'hours'), ('minutes', 'minutes')), default='hours', max_length=10)
+    # the duration in seconds whatever the unit, set on save: reports only add up this column
+    duration_seconds = models.IntegerField(default=0, editable=False)
     togglId = models.CharField(max_length=20, unique=True)
+    # the invoice that billed this entry, assigned when the invoice is generated
+    invoice = models.ForeignKey('Invoice', null=True, blank=True, on_delete=models.SET_NULL, related_name='time_entries')
+
+    SECONDS_PER_UNIT = {
+        'days': 8 * 3600,
+        'hours': 3600,
+        'minutes': 60,
+    }
 
     objects = TimeEntryDFManager()
 
+    class Meta:
+        indexes = [
+            # every report filters on a project and a start range
+            models.Index(fields=['project', 'start'], name='timeentry_project_start_idx'),
+        ]
+
+    def normalize_duration(self):
+        self.duration_seconds = int(round(self.duration * self.SECONDS_PER_UNIT[self.duration_unit]))
+
+    def save(self, *args, **kwargs):
+        self.normalize_duration()
+        return super(TimeEntry, self).save(*args, **kwargs)
+
     def __str__(self):
         return '{0} : {1}'.format(self.project, self.start.isoformat())
 
@@ -93,6 +342,96 @@ class TimeEntry(models.Model):
         }
 
 
+def to_cents(value):
+    """
+    Round an amount to cents. Floats (e.g. a default vat rate that was not saved yet) are converted through their
+    string representation, so 0.21 is 0.21 and not 0.2099999...
+    """
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+TOTAL_FIELDS = ['total_excl_vat', 'total_vat', 'total_incl_vat']
+
+
+class CacheGeneration(models.Model):
+    """
+    The generation of a group of cached results ('reporting', 'billing'): the time the group was last invalidated. The
+    cache keys of a group contain its generation, so invalidating the group makes all its entries unreachable. The
+    generation is kept in the database, an invalidation by one process (e.g. an import command) reaches the caches of
+    all other processes.
+    """
+    name = models.CharField(max_length=20, unique=True)
+    changed_at = models.DateTimeField()
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.name, self.changed_at)
+
+    @classmethod
+    def current(cls, name):
+        """
+        :return: a string to include in the cache keys of the group
+        """
+        changed_at = cls.objects.filter(name=name).values_list('changed_at', flat=True).first()
+        return changed_at.strftime('%Y%m%d%H%M%S%f') if changed_at else '0'
+
+    @classmethod
+    def invalidate(cls, name):
+        now = timezone.now()
+        if not cls.objects.filter(name=name).update(changed_at=now):
+            cls.objects.get_or_create(name=name, defaults={'changed_at': now})
+
+
+class NumberSequence(models.Model):
+    """
+    The last number handed out for a document type ('invoice', 'creditnote'), per year if INVOICE_NUMBERS_PER_YEAR
+    is set (year 0 otherwise). Numbers are allocated by incrementing the row in the transaction that saves the
+    document, so concurrent saves are serialized on this single row and never get the same number.
+    """
+    name = models.CharField(max_length=20)
+    year = models.IntegerField(default=0)
+    last_number = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('name', 'year')
+
+    def __str__(self):
+        return '{0} {1}: {2}'.format(self.name, self.year, self.last_number)
+
+    @classmethod
+    def next_number(cls, model, name, day):
+        """
+        Allocate the next number of a document type, must be called inside the transaction that saves the document.
+        With INVOICE_NUMBERS_PER_YEAR the year is part of the number: 20170001, 20170002, ...
+        A sequence that does not exist yet starts after the highest number already in the model's table.
+        """
+        year, offset = cls.year_and_offset(day)
+        sequence = cls.objects.filter(name=name, year=year)
+        # update first: this takes the write lock on the row (or the database) before anything is read
+        if not sequence.update(last_number=F('last_number') + 1):
+            numbers = model.objects.all()
+            if offset:
+                numbers = numbers.filter(number__gt=offset, number__lt=offset + 10000)
+            highest = numbers.aggregate(highest=Max('number'))['highest']
+            cls.objects.get_or_create(name=name, year=year, defaults={'last_number': highest - offset if highest else 0})
+            sequence.update(last_number=F('last_number') + 1)
+        return offset + sequence.values_list('last_number', flat=True).get()
+
+    @classmethod
+    def skip_to(cls, name, day, number):
+        """
+        Make sure a number that was filled in by hand is never allocated
+        """
+        year, offset = cls.year_and_offset(day)
+        if offset < number < offset + 10000 or not offset:
+            cls.objects.filter(name=name, year=year).update(last_number=Greatest(F('last_number'), number - offset))
+
+    @staticmethod
+    def year_and_offset(day):
+        if getattr(settings, 'INVOICE_NUMBERS_PER_YEAR', False):
+            return day.year, day.year * 10000
+        return 0, 0
+
+
 class Invoice(models.Model):
     """
     A model to store invoice data.
@@ -108,15 +447,46 @@ class Invoice(models.Model):
     paid = models.BooleanField(default=False)
     description = models.CharField(max_length=500, null=True, blank=True)
     is_credit_invoice = models.BooleanField(default=False)
+    # computed from days, the project rate and the invoice items on every save, see compute_totals
+    total_excl_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    total_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    total_incl_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date'], name='invoice_date_idx'),
+            models.Index(fields=['paid', 'date'], name='invoice_paid_date_idx'),
+            # finding the invoice of a project covering a day (uninvoiced time)
+            models.Index(fields=['project', 'start', 'end'], name='invoice_project_period_idx'),
+        ]
+
+    def compute_totals(self):
+        """
+        Set the stored totals: the days at the project rate plus the invoice items, each item at its own vat rate
+        if it has one. Uses the prefetched invoice items if they were prefetched.
+        """
+        vat_rate = Decimal(str(self.vat_rate))
+        total = Decimal(str(self.days)) * self.project.rate
+        vat = total * vat_rate
+        if self.id:
+            for item in self.invoiceitem_set.all():
+                total += item.price
+                vat += item.price * (item.vat_rate if item.vat_rate else vat_rate)
+        self.total_excl_vat = to_cents(total)
+        self.total_vat = to_cents(vat)
+        self.total_incl_vat = self.total_excl_vat + self.total_vat
 
     def save(self, *args, **kwargs):
-        ''' On save, update timestamps '''
+        ''' On save, update timestamps and totals '''
+        self.compute_totals()
         if not self.id:
-            if not self.number:
-                invoice_highest_number = Invoice.objects.all().order_by('-number').first()
-                latest_number = invoice_highest_number.number
-                self.number = latest_number + 1
             self.date = date.today()
+            with transaction.atomic():
+                if not self.number:
+                    self.number = NumberSequence.next_number(Invoice, 'invoice', self.date)
+                else:
+                    NumberSequence.skip_to('invoice', self.date, self.number)
+                return super(Invoice, self).save(*args, **kwargs)
         return super(Invoice, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -130,15 +500,26 @@ class CreditNote(models.Model):
     date = models.DateField(editable=False)
     amount = models.DecimalField(max_digits=8, decimal_places=2)
     description = models.CharField(max_length=500, null=True, blank=True)
+    total_excl_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    total_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    total_incl_vat = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+
+    def compute_totals(self):
+        self.total_excl_vat = to_cents(self.amount)
+        self.total_vat = to_cents(Decimal(str(self.amount)) * Decimal(str(self.vat_rate)))
+        self.total_incl_vat = self.total_excl_vat + self.total_vat
 
     def save(self, *args, **kwargs):
-        ''' On save, update timestamps '''
+        ''' On save, update timestamps and totals '''
+        self.compute_totals()
         if not self.id:
-            if not self.number:
-                credit_note_highest_number = CreditNote.objects.all().order_by('-number').first()
-                latest_number = credit_note_highest_number.number
-                self.number = latest_number + 1
             self.date = date.today()
+            with transaction.atomic():
+                if not self.number:
+                    self.number = NumberSequence.next_number(CreditNote, 'creditnote', self.date)
+                else:
+                    NumberSequence.skip_to('creditnote', self.date, self.number)
+                return super(CreditNote, self).save(*args, **kwargs)
         return super(CreditNote, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -149,4 +530,53 @@ class InvoiceItem(models.Model):
     invoice = models.ForeignKey(Invoice)
     description = models.TextField(null=True, blank=True)
     price = models.DecimalField(max_digits=7, decimal_places=2)
-    vat_rate = models.DecimalField(max_digits=7, decimal_places=2, help_text='If the VAT% is not equal to the overall VAT rate', null=True, blank=True)
\ No newline at end of file
+    vat_rate = models.DecimalField(max_digits=7, decimal_places=2, help_text='If the VAT% is not equal to the overall VAT rate', null=True, blank=True)
+
+
+class TogglImportWindow(models.Model):
+    """
+    Checkpoint of a toggl backfill: all time entries of the workspace from start up to (not including) end have
+    been imported. An interrupted backfill skips the windows that have a checkpoint when it is started again.
+    """
+    workspace_id = models.IntegerField()
+    start = models.DateField()
+    end = models.DateField()
+    entries = models.IntegerField(default=0)
+    imported_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('workspace_id', 'start', 'end')
+
+    def __str__(self):
+        return '{0}: {1} - {2}'.format(self.workspace_id, self.start, self.end)
+
+
+class SyncState(models.Model):
+    """
+    High-water mark of the incremental toggl sync (toggl-import --since-last): all changes made in the workspace
+    before last_synced_at have been imported.
+    """
+    workspace_id = models.IntegerField(unique=True)
+    last_synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.workspace_id, self.last_synced_at.isoformat())
+
+
+class RenderJob(models.Model):
+    """
+    A pdf to be rendered in the background by the render-worker command. The parameters are the (json encoded) query
+    parameters of the matching display_timesheet, display_invoice or display_creditnote view.
+    """
+    kind = models.CharField(choices=(('timesheet', 'timesheet'), ('invoice', 'invoice'), ('creditnote', 'creditnote')), max_length=20)
+    parameters = models.TextField()
+    status = models.CharField(choices=(('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')), default='queued', max_length=10, db_index=True)
+    filename = models.CharField(max_length=200, null=True, blank=True)
+    pdf = models.BinaryField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{0} {1}: {2}'.format(self.kind, self.parameters, self.status)
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # removed by another process in the meantime
+
+
+class PDFCache(object):
+    """
+    Content addressed cache of rendered pdfs. The key is a hash of the template name, the stylesheet and the rendered
+    html, so a cached pdf is only served for exactly the same input. Every entry is stored with a few tags (e.g.
+    'invoice-12', 'project-3') so that all entries of a document can be dropped when its data changes. The hits and
+    misses are counted per process, see the pdf_cache_stats view.
+
+    The rendering module (and so WeasyPrint) is only imported when a pdf is rendered: the signals that invalidate
+    the cache are connected in every process, also in management commands that never render a pdf.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stylesheet_hash = None
+
+    @property
+    def stylesheet_hash(self):
+        if self._stylesheet_hash is None:
+            from .rendering import STYLESHEET
+            with open(STYLESHEET, 'rb') as f:
+                self._stylesheet_hash = hashlib.sha256(f.read()).hexdigest()
+        return self._stylesheet_hash
+
+    def key(self, document, content):
+        digest = hashlib.sha256()
+        for part in (document.template, self.stylesheet_hash, content):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get_or_render(self, document, content):
+        """
+        :return: pdf bytes of the rendered html content of a document, from the cache if possible
+        """
+        from .rendering import html_to_pdf
+        key = self.key(document, content)
+        pdf = self.get(key)
+        if pdf is None:
+            self.misses += 1
+            pdf = html_to_pdf(content)
+            self.set(key, pdf, document.cache_tags)
+        else:
+            self.hits += 1
+        return pdf
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, pdf, tags):
+        raise NotImplementedError
+
+    def invalidate(self, tag):
+        raise NotImplementedError
+
+
+class DiskPDFCache(PDFCache):
+    """
+    Stores every pdf in a file named after its key, and an empty marker file per tag in tags/<tag>/<key>. When the
+    total size exceeds max_bytes, the least recently used pdfs are removed (every hit touches the file).
+    """
+    def __init__(self, directory, max_bytes):
+        super(DiskPDFCache, self).__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.pdf'.format(key))
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                pdf = f.read()
+            os.utime(self.path(key))
+            return pdf
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, pdf, tags):
+        for tag in tags:
+            os.makedirs(os.path.join(self.directory, 'tags', tag), exist_ok=True)
+            open(os.path.join(self.directory, 'tags', tag, key), 'w').close()
+        # write to a temporary file first, so other processes never read a partial pdf
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pdf'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        evicted = set()
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            remove(path)
+            evicted.add(os.path.basename(path)[:-len('.pdf')])
+            total -= size
+        if evicted:
+            self.remove_tags(evicted)
+
+    def invalidate(self, tag):
+        tag_directory = os.path.join(self.directory, 'tags', tag)
+        if os.path.isdir(tag_directory):
+            keys = set(os.listdir(tag_directory))
+            for key in keys:
+                remove(self.path(key))
+            self.remove_tags(keys)
+
+    def remove_tags(self, keys):
+        """
+        Remove the tag markers of removed pdfs, under all their tags
+        """
+        tags_directory = os.path.join(self.directory, 'tags')
+        if not os.path.isdir(tags_directory):
+            return
+        for entry in os.scandir(tags_directory):
+            for key in keys.intersection(os.listdir(entry.path)):
+                remove(os.path.join(entry.path, key))
+
+
+class DjangoPDFCache(PDFCache):
+    """
+    Stores the pdfs in the default Django cache, which takes care of expiry and eviction. The keys stored per tag are
+    kept in the cache as well.
+    """
+    prefix = 'pdfcache'
+
+    def get(self, key):
+        return cache.get('{}:{}'.format(self.prefix, key))
+
+    def set(self, key, pdf, tags):
+        cache.set('{}:{}'.format(self.prefix, key), pdf, None)
+        for tag in tags:
+            tag_key = '{}:tag:{}'.format(self.prefix, tag)
+            cache.set(tag_key, cache.get(tag_key, set()) | {key}, None)
+
+    def invalidate(self, tag):
+        tag_key = '{}:tag:{}'.format(self.prefix, tag)
+        keys = cache.get(tag_key, set())
+        cache.delete_many(['{}:{}'.format(self.prefix, key) for key in keys] + [tag_key])
+
+
+_pdf_cache = None
+
+
+def get_pdf_cache():
+    """
+    The pdf cache configured in the settings (PDF_CACHE_BACKEND 'disk' or 'django'), None if caching is disabled
+    """
+    global _pdf_cache
+    if _pdf_cache is None:
+        backend = getattr(settings, 'PDF_CACHE_BACKEND', None)
+        if backend == 'disk':
+            _pdf_cache = DiskPDFCache(settings.PDF_CACHE_DIR, settings.PDF_CACHE_MAX_BYTES)
+        elif backend == 'django':
+            _pdf_cache = DjangoPDFCache()
+    return _pdf_cache
+
+
+@receiver(setting_changed)
+def reset_pdf_cache(setting, **kwargs):
+    global _pdf_cache
+    if setting.startswith('PDF_CACHE_'):
+        _pdf_cache = None
+
+
+def cached_pdf(document, content):
+    """
+    :return: pdf bytes of the rendered html content of a document, from the pdf cache if it is enabled and the
+        document can be cached (has cache tags)
+    """
+    pdf_cache = get_pdf_cache()
+    if pdf_cache is None or not document.cache_tags:
+        from .rendering import html_to_pdf
+        return html_to_pdf(content)
+    return pdf_cache.get_or_render(document, content)
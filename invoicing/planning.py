@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+from datetime import timedelta
+from .models import Project, TimeEntry, WorkCalendar
+
+HOURS_PER_DAY = 8.0
+
+# Monday to Friday, for when no work calendar is configured
+DEFAULT_CALENDAR = np.busdaycalendar()
+
+
+def business_calendar(name=None, profile=None):
+    """
+    The numpy busdaycalendar of a work calendar, as found by WorkCalendar.lookup
+    """
+    calendar = WorkCalendar.lookup(name, profile)
+    if name and calendar is None:
+        raise ValueError(f'Unknown work calendar: {name}')
+    return calendar.busdaycalendar() if calendar is not None else DEFAULT_CALENDAR
+
+
+def month_range(start, end):
+    """
+    :return: array of the months (datetime64[M]) from the month of start up to and including the month of end
+    """
+    return np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1)
+
+
+def business_days(months, start, calendar):
+    """
+    Number of business days of every month in months, counting from start on (0 for months before start)
+    """
+    begin = np.maximum(months.astype('datetime64[D]'), np.datetime64(start, 'D'))
+    end = (months + 1).astype('datetime64[D]')
+    return np.maximum(np.busday_count(begin, end, busdaycal=calendar), 0)
+
+
+def default_shares(start, history_days=90):
+    """
+    Shares of the projects in the billable time of the history_days before start
+    :return: {project id: share}
+    """
+    totals = TimeEntry.objects.billable().in_range(start - timedelta(days=history_days), start).totals_by('project')
+    return dict(zip(totals['project'], totals['duration'] / totals['duration'].sum()))
+
+
+def forecast(start, end, shares, calendar=None):
+    """
+    Days and revenue per project and month, from start up to and including the month of end. The business days left
+    in every month (from start on) minus the days already booked on any project are free, the free days are divided
+    over the projects according to their share. A project's planned days are its booked days plus its part of the
+    free days, at the project's daily rate. The booked days are read with one aggregate query, the rest is computed on
+    arrays of projects x months.
+
+    :param shares: {project id: fraction of the free days planned for the project}, adding up to at most 1
+    :return: DataFrame with columns project, month ('2017-01'), booked_days, planned_days and revenue
+    """
+    if end < start:
+        raise ValueError(f'The end of the plan ({end}) is before its start ({start})')
+    if any(share < 0 for share in shares.values()) or sum(shares.values()) > 1 + 1e-9:
+        raise ValueError('Project shares must be positive and add up to at most 1')
+    if calendar is None:
+        calendar = business_calendar()
+    months = month_range(start, end)
+    projects = list(Project.objects.filter(pk__in=shares).order_by('name'))
+    project_share = np.array([shares[project.pk] for project in projects], dtype=float)
+    rate = np.array([project.rate for project in projects], dtype=float)
+
+    plan_end = (months[-1] + 1).astype('datetime64[D]').item()
+    totals = TimeEntry.objects.billable().in_range(start, plan_end).totals_by('project', 'year', 'month')
+    first_month = months[0].item()
+    month_index = ((totals['year'] - first_month.year) * 12 + totals['month'] - first_month.month).values.astype(int)
+    days = (totals['duration'] / HOURS_PER_DAY).values.astype(float)
+    project_index = pd.Index([project.pk for project in projects]).get_indexer(totals['project'])
+    planned_project = project_index >= 0
+    booked = np.zeros((len(projects), len(months)))
+    np.add.at(booked, (project_index[planned_project], month_index[planned_project]), days[planned_project])
+    booked_total = np.bincount(month_index, weights=days, minlength=len(months))
+
+    free = np.maximum(business_days(months, start, calendar) - booked_total, 0)
+    planned = booked + project_share[:, np.newaxis] * free[np.newaxis, :]
+    return pd.DataFrame({
+        'project': np.repeat([project.name for project in projects], len(months)),
+        'month': np.tile(months.astype(str), len(projects)),
+        'booked_days': booked.ravel(),
+        'planned_days': planned.ravel(),
+        'revenue': (planned * rate[:, np.newaxis]).ravel(),
+    })
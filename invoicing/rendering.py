@@ -0,0 +1,50 @@
+import time
+
+# WeasyPrint (and the cairo and pango libraries under it) is imported on the first render, so that importing this
+# module does not require it
+
+STYLESHEET = 'invoicing/static/theme.css'
+
+# parsed once per process and shared by every pdf rendered in it
+_font_config = None
+_stylesheets = None
+
+
+def get_font_config():
+    global _font_config
+    if _font_config is None:
+        try:
+            from weasyprint.text.fonts import FontConfiguration  # WeasyPrint >= 53
+        except ImportError:
+            from weasyprint.fonts import FontConfiguration
+        _font_config = FontConfiguration()
+    return _font_config
+
+
+def get_stylesheets():
+    global _stylesheets
+    if _stylesheets is None:
+        from weasyprint import CSS
+        _stylesheets = [CSS(filename=STYLESHEET, font_config=get_font_config())]
+    return _stylesheets
+
+
+def html_to_pdf(content, target=None):
+    """
+    Render html to pdf with the theme stylesheet. Writes to target (a file name or file-like object) if given,
+    otherwise returns the bytes.
+    """
+    from weasyprint import HTML
+    return HTML(string=content).write_pdf(target, stylesheets=get_stylesheets(), font_config=get_font_config())
+
+
+def timed_html_to_pdf(filename, content):
+    """
+    html_to_pdf for a process pool: this module does not import the models, so it also loads in processes that are
+    spawned instead of forked (the default on macOS), where Django is not set up.
+
+    :return: (filename, pdf bytes, seconds spent rendering)
+    """
+    t0 = time.perf_counter()
+    pdf = html_to_pdf(content)
+    return filename, pdf, time.perf_counter() - t0
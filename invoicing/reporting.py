@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Sum, Value, When
+from django.db.models.functions import ExtractMonth, ExtractYear
+from .models import TOTAL_FIELDS, CacheGeneration, CreditNote, Invoice
+
+# the aging buckets of unpaid invoices: (name, minimum age in days, maximum age in days or None)
+AGING_BUCKETS = [
+    ('0-30', 0, 30),
+    ('31-60', 31, 60),
+    ('61-90', 61, 90),
+    ('90+', 91, None),
+]
+
+REVENUE_KEYS = {
+    'year': ExtractYear('date'),
+    'month': ExtractMonth('date'),
+    'client': F('project__client__name'),
+    'project': F('project__name'),
+}
+
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def signed(field):
+    """
+    The value of a total field, negative for credit invoices
+    """
+    return Case(When(is_credit_invoice=True, then=F(field) * -1), default=F(field),
+                output_field=DecimalField(max_digits=10, decimal_places=2))
+
+
+def invalidate():
+    """
+    Drop all cached reports, called whenever an invoice or creditnote changes. The cache keys contain the generation
+    of the reports, moving to the next generation makes the old entries unreachable (they expire by themselves).
+    """
+    CacheGeneration.invalidate('reporting')
+
+
+def cached(name, compute, *params):
+    key = 'reporting:{0}:{1}:{2}'.format(CacheGeneration.current('reporting'), name,
+                                         ':'.join(','.join(x) if isinstance(x, tuple) else str(x) for x in params))
+    result = cache.get(key)
+    if result is None:
+        result = compute(*params)
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
+
+
+def grouped_totals(documents, keys, **totals):
+    """
+    Number of documents (count) and the given total aggregates of an Invoice or CreditNote queryset, grouped by keys
+    """
+    return documents.annotate(**{f'_{key}': REVENUE_KEYS[key] for key in keys})\
+        .values(*[f'_{key}' for key in keys])\
+        .annotate(count=Count('pk'), **totals).order_by()
+
+
+def revenue(start, end, keys=('year', 'month', 'client', 'project')):
+    """
+    Invoiced amounts of the invoices and creditnotes dated from start up to (not including) end, grouped by any of
+    year, month, client and project. Credit invoices and creditnotes are subtracted. One grouped query for the
+    invoices and one for the creditnotes, merged per key.
+    :return: list of dicts with the keys, the number of invoices and creditnotes and total_excl_vat, total_vat and
+        total_incl_vat
+    """
+    unknown = set(keys) - set(REVENUE_KEYS)
+    if unknown:
+        raise ValueError('Cannot group revenue by {}'.format(', '.join(sorted(unknown))))
+    invoices = grouped_totals(Invoice.objects.filter(date__gte=start, date__lt=end), keys,
+                              **{field: Sum(signed(field)) for field in TOTAL_FIELDS})
+    creditnotes = grouped_totals(CreditNote.objects.filter(date__gte=start, date__lt=end), keys,
+                                 **{field: Sum(field) for field in TOTAL_FIELDS})
+    rows = {}
+    for documents, count_name, sign in ((invoices, 'invoices', 1), (creditnotes, 'creditnotes', -1)):
+        for row in documents:
+            key = tuple(row[f'_{key}'] for key in keys)
+            merged = rows.setdefault(key, dict(zip(keys, key), invoices=0, creditnotes=0,
+                                               **{field: Decimal('0.00') for field in TOTAL_FIELDS}))
+            merged[count_name] = row['count']
+            for field in TOTAL_FIELDS:
+                merged[field] += sign * row[field]
+    return [rows[key] for key in sorted(rows)]
+
+
+def vat_per_quarter(start, end):
+    """
+    VAT invoiced per quarter for the invoices and creditnotes dated from start up to (not including) end. The query groups by month,
+    the months are added up per quarter here (quarters can't be extracted in SQL by this Django version).
+    :return: list of {'year', 'quarter', 'total_vat'} dicts
+    """
+    quarters = OrderedDict()
+    for row in revenue(start, end, ('year', 'month')):
+        key = (row['year'], (row['month'] - 1) // 3 + 1)
+        quarters[key] = quarters.get(key, 0) + row['total_vat']
+    return [{'year': year, 'quarter': quarter, 'total_vat': total_vat}
+            for (year, quarter), total_vat in quarters.items()]
+
+
+def unpaid_aging(today):
+    """
+    The outstanding amount (incl. VAT) and number of unpaid invoices per age bucket, the age is counted from the
+    invoice date. One query with a conditional sum per bucket.
+    :return: list of {'bucket', 'invoices', 'total_incl_vat'} dicts, in the order of AGING_BUCKETS
+    """
+    aggregates = {}
+    for name, min_age, max_age in AGING_BUCKETS:
+        condition = {'date__lte': today - timedelta(days=min_age)}
+        if max_age is not None:
+            condition['date__gte'] = today - timedelta(days=max_age)
+        aggregates[f'invoices_{name}'] = Sum(Case(When(then=Value(1), **condition), default=Value(0), output_field=IntegerField()))
+        aggregates[f'total_{name}'] = Sum(Case(When(then=signed('total_incl_vat'), **condition), default=Value(0),
+                                               output_field=DecimalField(max_digits=10, decimal_places=2)))
+    totals = Invoice.objects.filter(paid=False).aggregate(**aggregates)
+    return [{'bucket': name, 'invoices': totals[f'invoices_{name}'] or 0, 'total_incl_vat': totals[f'total_{name}'] or 0}
+            for name, _, _ in AGING_BUCKETS]
@@ -0,0 +1,68 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from . import billing, reporting
+from .models import TOTAL_FIELDS, CreditNote, Holiday, Invoice, InvoiceItem, Project, TimeEntry, WorkCalendar
+from .pdfcache import get_pdf_cache
+
+
+def invalidate_pdfs(tag):
+    pdf_cache = get_pdf_cache()
+    if pdf_cache is not None:
+        pdf_cache.invalidate(tag)
+
+
+@receiver([post_save, post_delete], sender=Invoice)
+def invoice_changed(sender, instance, **kwargs):
+    invalidate_pdfs(f'invoice-{instance.pk}')
+    reporting.invalidate()
+    billing.invalidate()
+
+
+@receiver([post_save, post_delete], sender=InvoiceItem)
+def invoice_item_changed(sender, instance, **kwargs):
+    invalidate_pdfs(f'invoice-{instance.invoice_id}')
+    # the invoice may have been deleted already
+    invoice = Invoice.objects.select_related('project').filter(pk=instance.invoice_id).first()
+    if invoice is not None:
+        invoice.save(update_fields=TOTAL_FIELDS)
+
+
+@receiver([post_save, post_delete], sender=TimeEntry)
+def time_entry_changed(sender, instance, **kwargs):
+    billing.invalidate()
+
+
+@receiver([post_save, post_delete], sender=CreditNote)
+def creditnote_changed(sender, instance, **kwargs):
+    invalidate_pdfs(f'creditnote-{instance.pk}')
+    reporting.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Project)
+def project_changed(sender, instance, **kwargs):
+    invalidate_pdfs(f'project-{instance.pk}')
+
+
+@receiver(pre_save, sender=Project)
+def project_saving(sender, instance, **kwargs):
+    instance._stored_rate = Project.objects.filter(pk=instance.pk).values_list('rate', flat=True).first()
+
+
+@receiver(post_save, sender=Project)
+def project_saved(sender, instance, created, **kwargs):
+    """
+    Recompute the totals of the unpaid invoices when the rate of a project changes. Paid invoices keep the totals
+    they were issued with, those have been reported already.
+    """
+    if created or instance._stored_rate == instance.rate:
+        return
+    for invoice in instance.invoice_set.filter(paid=False).prefetch_related('invoiceitem_set'):
+        invoice.project = instance
+        invoice.save(update_fields=TOTAL_FIELDS)
+
+
+@receiver([post_save, post_delete], sender=Holiday)
+def holiday_changed(sender, instance, **kwargs):
+    # busdaycalendars built from the calendar before this change are rebuilt on their next use
+    WorkCalendar.objects.filter(pk=instance.calendar_id).update(changed_at=timezone.now())
@@ -1,3 +1,876 @@
-from django.test import TestCase
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from io import BytesIO, StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from utils.TogglPy import Endpoints, Toggl
+from . import billing, export, jobs, planning, reporting
+from .documents import Document, InvoiceContextBuilder, timesheet_document
+from .jobs import Worker
+from .models import Client, CreditNote, Holiday, Invoice, InvoiceItem, NumberSequence, Profile, Project, RenderJob, \
+    SyncState, TimeEntry, TimeEntryQuerySet, TogglImportWindow, WorkCalendar
+from .pdfcache import DiskPDFCache, get_pdf_cache
+from .rendering import timed_html_to_pdf
+from .timesheet import daily_durations, reindex_days, weekly_calendar
+from .toggl import Backfill, TimeEntryImporter, sync_since_last
+
+
+def setUpModule():
+    # saving documents invalidates their cached pdfs by id: keep the pdf cache of the development server out of reach
+    global pdf_cache_settings
+    pdf_cache_settings = override_settings(PDF_CACHE_DIR=tempfile.mkdtemp())
+    pdf_cache_settings.enable()
+
+
+def tearDownModule():
+    shutil.rmtree(settings.PDF_CACHE_DIR)
+    pdf_cache_settings.disable()
+
+
+def create_project(name='project', togglId='1'):
+    client = Client.objects.create(name=f'client {name}', VAT_number=f'BE{togglId}',
+                                   address_line_1='Street 1', address_line_2='1000 City')
+    user = User.objects.create(username=f'user {name}')
+    profile = Profile.objects.create(user=user, invoice_name='Me', address_line_1='Street 2', address_line_2='2000 City',
+                                     bank_account=f'BE00{togglId}', phone=f'0{togglId}', email='me@example.com',
+                                     VAT_number=f'BE0{togglId}')
+    return Project.objects.create(client=client, user=profile, name=name, rate=500, vat_rate=0.21, togglId=togglId,
+                                  invoice_template='invoice.html', credit_template='invoice.html')
+
+
+class TimesheetTest(TestCase):
+    def test_entry_starting_at_midnight_is_counted_once(self):
+        entries = pd.DataFrame({
+            'start': pd.to_datetime(['2017-01-01 23:00', '2017-01-02 00:00', '2017-01-02 09:00'], utc=True),
+            'duration': [1.0, 2.0, 4.0],
+        })
+        daily = daily_durations(entries, '2017-01-01', '2017-01-03')
+        self.assertEqual(daily.tolist(), [1.0, 6.0, 0.0])
+        weeks = weekly_calendar(daily)
+        self.assertEqual([{day: entry['duration'] for day, entry in week.items()} for week in weeks],
+                         [{'sunday': 1.0}, {'monday': 6.0, 'tuesday': 0.0}])
+
+    def test_daily_totals_of_midnight_entries(self):
+        project = create_project()
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=project, start=datetime(2017, 1, 2, tzinfo=pytz.utc), duration=2, togglId='1'),
+            TimeEntry(project=project, start=datetime(2017, 1, 2, 23, tzinfo=pytz.utc), duration=1, togglId='2'),
+        ])
+        daily = reindex_days(TimeEntry.objects.daily_totals(project, date(2017, 1, 1), date(2017, 1, 4)),
+                             '2017-01-01', '2017-01-03')
+        self.assertEqual(daily.tolist(), [0.0, 3.0, 0.0])
+        self.assertEqual(weekly_calendar(daily)[1]['monday']['duration'], 3.0)
+
+
+class TimeEntryTotalsTest(TestCase):
+    def test_totals_by_project_year_and_month(self):
+        project = create_project()
+        other = create_project('other', togglId='2')
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=project, start=datetime(2017, 1, 31, 23, tzinfo=pytz.utc), duration=2, togglId='1'),
+            TimeEntry(project=project, start=datetime(2017, 2, 1, tzinfo=pytz.utc), duration=3, togglId='2'),
+            TimeEntry(project=project, start=datetime(2017, 2, 10, tzinfo=pytz.utc), duration=1, togglId='3'),
+            TimeEntry(project=other, start=datetime(2018, 2, 1, tzinfo=pytz.utc), duration=4, togglId='4'),
+        ])
+        totals = TimeEntry.objects.totals_by('project', 'year', 'month')
+        self.assertEqual(list(totals.columns), ['project', 'year', 'month', 'duration'])
+        self.assertEqual(totals.values.tolist(), [[project.pk, 2017, 1, 2], [project.pk, 2017, 2, 4],
+                                                  [other.pk, 2018, 2, 4]])
+        self.assertEqual(TimeEntry.objects.totals_by('year', project=other).values.tolist(), [[2018, 4]])
+
+    def test_unknown_key(self):
+        with self.assertRaises(ValueError):
+            TimeEntry.objects.totals_by('client')
+
+
+class TimeEntryQueryPlanTest(TestCase):
+    """
+    Guard against report queries falling back to a full scan of the time entries table
+    """
+    def setUp(self):
+        self.project = create_project()
+        self.start = datetime(2017, 1, 1, tzinfo=pytz.utc)
+        self.end = datetime(2018, 1, 1, tzinfo=pytz.utc)
+
+    def query_plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, sql, index='timeentry_project_start_idx'):
+        plan = self.query_plan(sql)
+        self.assertIsNone(re.search(r'\bSCAN (TABLE )?"?invoicing_timeentry\b', plan), plan)
+        self.assertIn(index, plan)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+    def test_timesheet_entries_query(self):
+        entries = TimeEntry.objects.filter(project=self.project, start__gte=self.start, start__lt=self.end)
+        sql, params = entries.query.sql_with_params()
+        self.assertUsesIndex(connection.ops.last_executed_query(None, sql, params))
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+    def test_daily_totals_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            TimeEntry.objects.daily_totals(self.project, self.start, self.end)
+        self.assertEqual(len(queries), 1)
+        self.assertUsesIndex(queries[0]['sql'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+    def test_billable_entries_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            TimeEntry.objects.billable().daily_totals(self.project, self.start, self.end)
+        self.assertUsesIndex(queries[0]['sql'], 'timeentry_billable_project_start_idx')
+
+
+class TimeEntryFrameTest(TestCase):
+    def test_columns_are_compactly_typed(self):
+        project = create_project()
+        TimeEntry.objects.bulk_create([TimeEntry(project=project, start=datetime(2017, 1, 1, i, tzinfo=pytz.utc),
+                                                 duration=0.25 * i, togglId=str(i)) for i in range(5)])
+        columns = ['project_id', 'start', 'duration', 'duration_unit', 'billable']
+        with mock.patch.object(TimeEntryQuerySet, 'FRAME_CHUNK_SIZE', 2):
+            frame = TimeEntry.objects.get_frame(columns, project=project)
+        self.assertEqual([str(dtype) for dtype in frame.dtypes],
+                         ['int32', 'datetime64[ns, UTC]', 'float32', 'category', 'bool'])
+        self.assertEqual(sorted(frame['duration']), [0, 0.25, 0.5, 0.75, 1.0])
+        self.assertEqual(frame['start'].min(), pd.Timestamp('2017-01-01', tz='UTC'))
+        self.assertEqual(len(TimeEntry.objects.get_frame(columns, project=project, billable=False)), 0)
+
+
+class TimeOverviewTest(TestCase):
+    def setUp(self):
+        project = create_project()
+        other_project = create_project('other', togglId='2')
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=project, start=datetime(2016, 12, 31, 9, tzinfo=pytz.utc), duration=4, togglId='1'),
+            TimeEntry(project=project, start=datetime(2017, 1, 2, 9, tzinfo=pytz.utc), duration=1, duration_unit='days',
+                      togglId='2'),
+            TimeEntry(project=other_project, start=datetime(2017, 1, 3, 9, tzinfo=pytz.utc), duration=240,
+                      duration_unit='minutes', togglId='3'),
+            TimeEntry(project=other_project, start=datetime(2017, 1, 4, 9, tzinfo=pytz.utc), duration=8,
+                      togglId='4', billable=False),
+        ])
+
+    def overview(self, *args):
+        output = StringIO()
+        with self.assertNumQueries(1):
+            call_command('time-overview', *args, format='json', stdout=output)
+        return json.loads(output.getvalue())
+
+    def test_overview_by_year_and_week(self):
+        self.assertEqual(self.overview(), [{'project': 'other', 'year': 2017, 'total_days': 0.5},
+                                           {'project': 'project', 'year': 2016, 'total_days': 0.5},
+                                           {'project': 'project', 'year': 2017, 'total_days': 1.0}])
+        self.assertEqual(self.overview('--by', 'week', '--since', '2017-01-01'),
+                         [{'project': 'other', 'week': '2017-W01', 'total_days': 0.5},
+                          {'project': 'project', 'week': '2017-W01', 'total_days': 1.0}])
+        self.assertEqual(self.overview('--since', '2018-01-01'), [])
+        self.assertEqual(self.overview('--since', '2017-01-03', '--include-non-billable'),
+                         [{'project': 'other', 'year': 2017, 'total_days': 1.5}])
+
+    def test_durations_are_normalized_on_save(self):
+        self.assertEqual(sorted(TimeEntry.objects.values_list('duration_seconds', flat=True)),
+                         [14400, 14400, 28800, 28800])
+        entry = TimeEntry.objects.get(togglId='3')
+        entry.duration = 90
+        entry.save()
+        self.assertEqual(TimeEntry.objects.get(togglId='3').duration_seconds, 5400)
+
+
+class UninvoicedTimeTest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.other_project = other_project = create_project('other', togglId='2')
+        Invoice.objects.create(project=self.project, start=date(2017, 1, 1), end=date(2017, 1, 31), days=1)
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=self.project, start=datetime(2017, 1, 31, 18, tzinfo=pytz.utc), duration=1, togglId='1'),
+            TimeEntry(project=self.project, start=datetime(2017, 2, 1, 9, tzinfo=pytz.utc), duration=2, togglId='2'),
+            TimeEntry(project=self.project, start=datetime(2017, 2, 2, 9, tzinfo=pytz.utc), duration=3, togglId='3',
+                      billable=False),
+            TimeEntry(project=other_project, start=datetime(2017, 1, 15, 9, tzinfo=pytz.utc), duration=4, togglId='4'),
+        ])
+        billing.invalidate()
+
+    def test_entries_outside_invoice_periods(self):
+        with self.assertNumQueries(1):
+            entries = list(billing.uninvoiced_entries().order_by('togglId').values_list('togglId', flat=True))
+        self.assertEqual(entries, ['2', '4'])
+
+    def test_totals_are_cached_until_an_invoice_is_saved(self):
+        self.assertEqual(billing.uninvoiced_totals(), {self.project.pk: 2.0, self.other_project.pk: 4.0})
+        # only the generation of the cached totals is read
+        with self.assertNumQueries(1):
+            billing.uninvoiced_totals()
+        Invoice.objects.create(project=self.project, start=date(2017, 2, 1), end=date(2017, 2, 28), days=1)
+        self.assertEqual(billing.uninvoiced_totals(), {self.other_project.pk: 4.0})
+
+    def test_overview_page(self):
+        response = self.client.get('/admin/overview/')
+        self.assertEqual([entry.togglId for entry in response.context['uninvoiced_entries']], ['4', '2'])
+
+
+class CreateInvoiceTest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=self.project, start=datetime(2017, 1, 1, 9, tzinfo=pytz.utc), duration=8, togglId='1'),
+            TimeEntry(project=self.project, start=datetime(2017, 1, 31, 20, tzinfo=pytz.utc), duration=4, togglId='2'),
+            TimeEntry(project=self.project, start=datetime(2017, 1, 2, 9, tzinfo=pytz.utc), duration=8, togglId='3',
+                      billable=False),
+            TimeEntry(project=self.project, start=datetime(2017, 2, 1, 9, tzinfo=pytz.utc), duration=8, togglId='4'),
+        ])
+
+    def test_entries_are_linked_and_days_computed(self):
+        invoice = billing.create_invoice(self.project, date(2017, 1, 1), date(2017, 1, 31), date(2017, 1, 31))
+        self.assertEqual(sorted(invoice.time_entries.values_list('togglId', flat=True)), ['1', '2'])
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).days, Decimal('1.50'))
+        self.assertEqual(list(billing.uninvoiced_entries().values_list('togglId', flat=True)), ['4'])
+        # already invoiced entries are not invoiced again, days given by hand are kept
+        invoice = billing.create_invoice(self.project, date(2017, 1, 1), date(2017, 2, 28), days=Decimal('2'))
+        self.assertEqual(list(invoice.time_entries.values_list('togglId', flat=True)), ['4'])
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).days, Decimal('2.00'))
+
+
+class YearPlanningTest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.other_project = create_project('other', togglId='2')
+        TimeEntry.objects.bulk_create([
+            TimeEntry(project=self.project, start=datetime(2017, 1, 17, 9, tzinfo=pytz.utc), duration=16, togglId='1'),
+            TimeEntry(project=self.project, start=datetime(2017, 1, 18, 9, tzinfo=pytz.utc), duration=8, togglId='2',
+                      billable=False),
+            TimeEntry(project=self.other_project, start=datetime(2017, 2, 1, 9, tzinfo=pytz.utc), duration=8,
+                      togglId='3'),
+        ])
+
+    def plan(self, by='month'):
+        output = StringIO()
+        call_command('year-planning', '--start', '2017-01-16', '--end', '2017-02-28', '--share', 'project=0.5',
+                     '--share', 'other=0.25', by=by, format='json', stdout=output)
+        return [(row['project'], row[by], row['planned_days'], row['revenue'])
+                for row in json.loads(output.getvalue())]
+
+    def test_free_business_days_are_shared(self):
+        # 12 business days left in January, 20 in February, minus the booked days
+        self.assertEqual(self.plan(), [('other', '2017-01', 2.5, 1250), ('other', '2017-02', 5.75, 2875),
+                                       ('project', '2017-01', 7, 3500), ('project', '2017-02', 9.5, 4750)])
+        calendar = WorkCalendar.objects.create(name='BE', country='BE')
+        Holiday.objects.create(calendar=calendar, date=date(2017, 1, 20))
+        with self.settings(WORK_CALENDAR='BE'):
+            self.assertEqual(self.plan('year'), [('other', '2017', 8, 4000), ('project', '2017', 16, 8000)])
+
+    def test_end_before_start(self):
+        with self.assertRaisesMessage(CommandError, 'before its start'):
+            call_command('year-planning', '--start', '2017-06-01', '--end', '2017-01-01', stdout=StringIO())
+
+    def test_default_shares_follow_recent_time(self):
+        self.assertEqual(planning.default_shares(date(2017, 3, 1)), {self.project.pk: 2 / 3, self.other_project.pk: 1 / 3})
+
+
+class WorkCalendarTest(TestCase):
+    def setUp(self):
+        self.calendar = WorkCalendar.objects.create(name='BE', country='BE')
+        Holiday.objects.create(calendar=self.calendar, date=date(2017, 1, 2), name='holiday')
+        self.project = create_project()
+        self.project.user.work_calendar = self.calendar
+        self.project.user.save()
+
+    def test_busdaycalendar_is_rebuilt_when_holidays_change(self):
+        busdaycalendar = WorkCalendar.objects.get(name='BE').busdaycalendar()
+        self.assertEqual(list(busdaycalendar.holidays), [np.datetime64('2017-01-02')])
+        with self.assertNumQueries(1):
+            self.assertIs(WorkCalendar.objects.get(name='BE').busdaycalendar(), busdaycalendar)
+        Holiday.objects.create(calendar=self.calendar, date=date(2017, 1, 3))
+        self.assertEqual(len(WorkCalendar.objects.get(name='BE').busdaycalendar().holidays), 2)
+
+    def test_profiles_without_calendar_use_their_country(self):
+        other = create_project('other', togglId='2').user
+        other.country = 'BE'
+        self.assertEqual(WorkCalendar.lookup(profile=other), self.calendar)
+        other.country = 'NL'
+        self.assertIsNone(WorkCalendar.lookup(profile=other))
+
+    def test_weekmask_is_validated(self):
+        for weekmask in ('11111', '1111102', '0000000'):
+            with self.assertRaises(ValidationError):
+                WorkCalendar.objects.create(name=weekmask, weekmask=weekmask)
+
+    def test_timesheet_marks_non_working_days(self):
+        context = timesheet_document(self.project, '2017-01-01', '2017-01-08').context
+        working = [day for day, entry in context['entries_by_week'][1].items() if entry['working']]
+        self.assertEqual(working, ['tuesday', 'wednesday', 'thursday', 'friday'])
+
+
+class FakeTogglServer(object):
+    """
+    Local stand-in for the toggl API, to be used as a context manager. Serves `entries` (in the detailed report
+    format) in pages of `per_page` on the detailed report endpoint and `time_entries` (in the v9 format) on the
+    endpoint listing the user's time entries. The first `failures` requests are answered with a 429 (rate
+    limited). All received query strings are kept in `requests`.
+    """
+    def __init__(self, entries=(), per_page=50, failures=0, time_entries=()):
+        self.entries = entries
+        self.time_entries = time_entries
+        self.per_page = per_page
+        self.failures = failures
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                with fake.lock:
+                    fake.requests.append(query)
+                    rate_limited = fake.failures > 0
+                    fake.failures -= 1
+                if rate_limited:
+                    self.respond(429, {'error': 'rate limited'})
+                elif url.path == '/reports/api/v2/details':
+                    self.respond(200, fake.details(query))
+                elif url.path == '/api/v9/me/time_entries':
+                    self.respond(200, list(fake.time_entries))
+                else:
+                    self.respond(404, {})
+
+            def respond(self, status, body):
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def details(self, query):
+        entries = [x for x in self.entries
+                   if ('project_ids' not in query or str(x['pid']) == query['project_ids'])
+                   and query.get('since', '') <= x['start'][:10] <= query.get('until', '9999')]
+        page = int(query.get('page', 1))
+        return {
+            'total_count': len(entries),
+            'per_page': self.per_page,
+            'data': entries[(page - 1) * self.per_page:page * self.per_page],
+        }
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.patches = [
+            mock.patch.object(Endpoints, 'REPORT_DETAILED', url + '/reports/api/v2/details'),
+            mock.patch.object(Endpoints, 'MY_TIME_ENTRIES', url + '/api/v9/me/time_entries'),
+        ]
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def report_entries(count, pid=42, first_id=1):
+    return [{
+        'id': first_id + i,
+        'pid': pid,
+        'description': 'work',
+        'start': '2017-01-{:02}T09:00:00+01:00'.format(i % 28 + 1),
+        'end': '2017-01-{:02}T11:00:00+01:00'.format(i % 28 + 1),
+        'dur': 2 * 3600 * 1000,
+        'is_billable': i % 4 != 0,
+        'updated': '2017-02-01T09:00:00+01:00',
+    } for i in range(count)]
+
+
+class TogglFetchTest(TestCase):
+    def setUp(self):
+        self.toggl = Toggl(backoff_factor=0)
+        self.toggl.setAPIKey('secret')
+
+    def test_iter_time_entries_pages_through_report(self):
+        with FakeTogglServer(report_entries(120), per_page=50) as server:
+            entries = list(self.toggl.iterTimeEntries(date(2017, 1, 1), date(2017, 1, 31), workspace_id=7))
+        self.assertEqual([x['page'] for x in server.requests], ['1', '2', '3'])
+        self.assertEqual(server.requests[0]['since'], '2017-01-01')
+        self.assertEqual(server.requests[0]['workspace_id'], '7')
+        self.assertEqual(len(entries), 120)
+        self.assertEqual(entries[0]['duration'], 7200)
+        self.assertEqual(entries[0]['pid'], 42)
+
+    def test_iter_time_entries_filters_project_server_side(self):
+        with FakeTogglServer(report_entries(10) + report_entries(10, pid=43, first_id=100)) as server:
+            entries = list(self.toggl.iterTimeEntries(date(2017, 1, 1), date(2017, 1, 31), 7, projectid=43))
+        self.assertEqual(server.requests[0]['project_ids'], '43')
+        self.assertEqual({x['pid'] for x in entries}, {43})
+
+    def test_rate_limited_requests_are_retried(self):
+        with FakeTogglServer(report_entries(10), failures=2) as server:
+            entries = list(self.toggl.iterTimeEntries(date(2017, 1, 1), date(2017, 1, 31), 7))
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(len(entries), 10)
+
+    def test_import_streamed_entries(self):
+        project = create_project(togglId='42')
+        with FakeTogglServer(report_entries(120), per_page=50):
+            importer = TimeEntryImporter(batch_size=20)
+            importer.import_entries(self.toggl.iterTimeEntries(date(2017, 1, 1), date(2017, 1, 31), 7))
+        self.assertEqual(importer.inserted, 120)
+        self.assertEqual(project.timeentry_set.count(), 120)
+        self.assertEqual(project.timeentry_set.first().duration, 2.0)
+        self.assertEqual(project.timeentry_set.filter(billable=True).count(), 90)
+
+    def test_backfill_resumes_after_interruption(self):
+        project = create_project(togglId='42')
+        entries = report_entries(56)
+        for i, entry in enumerate(entries):
+            entry['start'] = '2017-{:02}-10T09:00:00+01:00'.format(i % 4 + 1)
+        TogglImportWindow.objects.create(workspace_id=7, start=date(2017, 1, 1), end=date(2017, 2, 1))
+        with FakeTogglServer(entries) as server:
+            backfill = Backfill(self.toggl, 7, TimeEntryImporter(), workers=3)
+            windows = backfill.run(date(2017, 1, 1), date(2017, 5, 1), chunk='month')
+        self.assertEqual(windows, 3)
+        self.assertNotIn('2017-01-01', [x['since'] for x in server.requests])
+        self.assertEqual(project.timeentry_set.count(), 42)
+        self.assertEqual(TogglImportWindow.objects.filter(workspace_id=7).count(), 4)
+
+    def test_sync_since_last_applies_changes(self):
+        project = create_project(togglId='42')
+        for togglId in ('1', '2'):
+            TimeEntry.objects.create(project=project, start=datetime(2017, 1, 2, 9, tzinfo=pytz.utc), duration=1.0,
+                                     togglId=togglId)
+        last_sync = datetime(2017, 1, 3, tzinfo=pytz.utc)
+        SyncState.objects.create(workspace_id=7, last_synced_at=last_sync)
+        changes = [
+            {'id': 1, 'workspace_id': 7, 'project_id': 42, 'start': '2017-01-02T09:00:00Z', 'duration': 7200,
+             'billable': False},
+            {'id': 2, 'workspace_id': 7, 'project_id': 42, 'start': '2017-01-02T09:00:00Z', 'duration': 3600,
+             'server_deleted_at': '2017-01-04T09:00:00Z'},
+            {'id': 3, 'workspace_id': 7, 'project_id': 42, 'start': '2017-01-03T09:00:00Z', 'duration': 3600},
+            {'id': 4, 'workspace_id': 8, 'project_id': 42, 'start': '2017-01-03T09:00:00Z', 'duration': 3600},
+        ]
+        with FakeTogglServer(time_entries=changes) as server:
+            importer = TimeEntryImporter(update=True)
+            state = sync_since_last(self.toggl, 7, importer)
+        self.assertEqual(server.requests[0]['since'], str(int(last_sync.timestamp())))
+        self.assertGreater(state.last_synced_at, last_sync)
+        self.assertEqual((importer.inserted, importer.updated, importer.deleted), (1, 1, 1))
+        self.assertEqual(dict(project.timeentry_set.values_list('togglId', 'duration')), {'1': 2.0, '3': 1.0})
+        self.assertEqual(dict(project.timeentry_set.values_list('togglId', 'billable')), {'1': False, '3': True})
+
+
+class DiskPDFCacheTest(TestCase):
+    def setUp(self):
+        self.pdf_cache = DiskPDFCache(tempfile.mkdtemp(), max_bytes=1024)
+        self.addCleanup(shutil.rmtree, self.pdf_cache.directory)
+        self.document = Document('invoice.html', {}, '1_invoice.pdf', ('invoice-1', 'project-1'))
+
+    @mock.patch('invoicing.rendering.html_to_pdf', return_value=b'%PDF')
+    def test_hit_miss_and_invalidation(self, html_to_pdf):
+        self.assertEqual(self.pdf_cache.get_or_render(self.document, '<html>1</html>'), b'%PDF')
+        self.assertEqual(self.pdf_cache.get_or_render(self.document, '<html>1</html>'), b'%PDF')
+        self.assertEqual(self.pdf_cache.get_or_render(self.document, '<html>2</html>'), b'%PDF')
+        self.assertEqual(self.pdf_cache.stats(), {'hits': 1, 'misses': 2})
+        self.pdf_cache.invalidate('project-1')
+        self.pdf_cache.get_or_render(self.document, '<html>1</html>')
+        self.assertEqual(self.pdf_cache.stats(), {'hits': 1, 'misses': 3})
+        self.assertEqual(html_to_pdf.call_count, 3)
+
+    def test_least_recently_used_pdfs_are_evicted(self):
+        for i in range(2):
+            self.pdf_cache.set(str(i), b'x' * 400, ('invoice-{}'.format(i),))
+            os.utime(self.pdf_cache.path(str(i)), (i, i))
+        self.pdf_cache.get('0')
+        self.pdf_cache.set('2', b'x' * 400, ('invoice-2',))
+        self.assertEqual([self.pdf_cache.get(str(i)) is not None for i in range(3)], [True, False, True])
+        self.assertEqual(self.tag_markers(), [('invoice-0', '0'), ('invoice-2', '2')])
+        self.pdf_cache.set('3', b'x' * 100, ('invoice-3', 'project-1'))
+        self.pdf_cache.invalidate('invoice-3')
+        self.assertEqual(self.tag_markers(), [('invoice-0', '0'), ('invoice-2', '2')])
+
+    def tag_markers(self):
+        tags_directory = os.path.join(self.pdf_cache.directory, 'tags')
+        return sorted((tag, key) for tag in os.listdir(tags_directory)
+                      for key in os.listdir(os.path.join(tags_directory, tag)))
+
+    def test_configured_cache_follows_the_settings(self):
+        self.assertEqual(get_pdf_cache().directory, settings.PDF_CACHE_DIR)
+        with self.settings(PDF_CACHE_BACKEND=None):
+            self.assertIsNone(get_pdf_cache())
+        self.assertEqual(get_pdf_cache().directory, settings.PDF_CACHE_DIR)
+
+    def test_stats_view(self):
+        with mock.patch('invoicing.views.get_pdf_cache', return_value=self.pdf_cache):
+            self.assertEqual(self.client.get('/admin/pdf_cache/').json(),
+                             {'enabled': True, 'hits': 0, 'misses': 0, 'pid': os.getpid()})
+
+
+class InvoiceContextBuilderTest(TestCase):
+    def setUp(self):
+        project = create_project()
+        Invoice.objects.bulk_create([
+            Invoice(project=project, number=number, date=date(2017, 2, 1), start=date(2017, 1, 1),
+                    end=date(2017, 1, 31), delivery_date=date(2017, 1, 31), days=10)
+            for number in range(1, 501)])
+        InvoiceItem.objects.bulk_create([InvoiceItem(invoice=invoice, description='travel', price=100)
+                                         for invoice in Invoice.objects.all() for _ in range(2)])
+        call_command('recompute-totals', stdout=StringIO())  # bulk_create skips save and the signals
+        self.builder = InvoiceContextBuilder()
+
+    def test_one_invoice(self):
+        invoice_id = Invoice.objects.get(number=1).pk
+        with self.assertNumQueries(2):
+            document = self.builder.document(self.builder.get(invoice_id))
+        self.assertEqual(document.context['total'], '5200.00')
+        self.assertEqual(len(document.context['invoice_items']), 3)
+
+    def test_many_invoices(self):
+        with self.assertNumQueries(2):
+            documents = self.builder.documents(Invoice.objects.all())
+        self.assertEqual(len(documents), 500)
+        self.assertEqual(documents[-1].filename, '500_invoice_project.pdf')
+
+
+class InvoiceTotalsTest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        self.invoice = Invoice.objects.create(project=self.project, start=date(2017, 1, 1), end=date(2017, 1, 31),
+                                              days=2, vat_rate=0.21)
+
+    def assertTotals(self, excl_vat, vat, incl_vat):
+        self.invoice.refresh_from_db()
+        self.assertEqual((self.invoice.total_excl_vat, self.invoice.total_vat, self.invoice.total_incl_vat),
+                         (Decimal(excl_vat), Decimal(vat), Decimal(incl_vat)))
+
+    def test_totals_follow_items_and_rate(self):
+        self.assertTotals('1000.00', '210.00', '1210.00')
+        item = InvoiceItem.objects.create(invoice=self.invoice, description='travel', price=100, vat_rate=0.06)
+        self.assertTotals('1100.00', '216.00', '1316.00')
+        item.delete()
+        self.assertTotals('1000.00', '210.00', '1210.00')
+        self.project.rate = 600
+        self.project.save()
+        self.assertTotals('1200.00', '252.00', '1452.00')
+
+    def test_paid_invoices_keep_their_totals(self):
+        self.invoice.paid = True
+        self.invoice.save()
+        unpaid = Invoice.objects.create(project=self.project, start=date(2017, 2, 1), end=date(2017, 2, 28), days=1,
+                                        vat_rate=0.21)
+        self.project.rate = 600
+        self.project.save()
+        self.assertTotals('1000.00', '210.00', '1210.00')
+        unpaid.refresh_from_db()
+        self.assertEqual(unpaid.total_incl_vat, Decimal('726.00'))
+
+    def test_saving_a_project_without_rate_change(self):
+        Invoice.objects.update(total_excl_vat=0)
+        self.project.name = 'renamed'
+        with self.assertNumQueries(2):
+            self.project.save()
+        self.assertEqual(Invoice.objects.get().total_excl_vat, 0)
+
+    def test_recompute_totals_command(self):
+        Invoice.objects.update(total_excl_vat=0, total_vat=0, total_incl_vat=0)
+        call_command('recompute-totals', stdout=StringIO())
+        self.assertTotals('1000.00', '210.00', '1210.00')
+
+
+class ReportingTest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        other_project = create_project('other', togglId='2')
+        for project, day, days, paid, is_credit_invoice in [(self.project, date(2017, 1, 10), 2, True, False),
+                                                             (self.project, date(2017, 2, 10), 1, False, False),
+                                                             (other_project, date(2017, 2, 20), 4, False, False),
+                                                             (self.project, date(2017, 4, 1), 1, True, True)]:
+            invoice = Invoice.objects.create(project=project, start=day, end=day, days=days, paid=paid,
+                                             is_credit_invoice=is_credit_invoice)
+            Invoice.objects.filter(pk=invoice.pk).update(date=day)
+        creditnote = CreditNote.objects.create(project=other_project, amount=100)
+        CreditNote.objects.filter(pk=creditnote.pk).update(date=date(2017, 2, 25))
+
+    def test_revenue_by_month_in_two_queries(self):
+        with self.assertNumQueries(2):
+            rows = reporting.revenue(date(2017, 1, 1), date(2018, 1, 1), ('month',))
+        self.assertEqual([(row['month'], row['invoices'], row['creditnotes'], row['total_excl_vat']) for row in rows],
+                         [(1, 1, 0, 1000), (2, 2, 1, 2400), (4, 1, 0, -500)])
+        rows = reporting.revenue(date(2017, 1, 1), date(2018, 1, 1), ('client',))
+        self.assertEqual({row['client']: row['total_incl_vat'] for row in rows},
+                         {'client project': Decimal('1210.00'), 'client other': Decimal('2299.00')})
+
+    def test_vat_per_quarter(self):
+        self.assertEqual(reporting.vat_per_quarter(date(2017, 1, 1), date(2018, 1, 1)),
+                         [{'year': 2017, 'quarter': 1, 'total_vat': Decimal('714.00')},
+                          {'year': 2017, 'quarter': 2, 'total_vat': Decimal('-105.00')}])
+
+    def test_unpaid_aging(self):
+        with self.assertNumQueries(1):
+            buckets = reporting.unpaid_aging(date(2017, 3, 15))
+        self.assertEqual([(x['bucket'], x['invoices'], x['total_incl_vat']) for x in buckets],
+                         [('0-30', 1, Decimal('2420.00')), ('31-60', 1, Decimal('605.00')), ('61-90', 0, 0), ('90+', 0, 0)])
+
+    def test_cached_report_is_invalidated_on_save(self):
+        def total():
+            return reporting.cached('revenue', reporting.revenue, date(2017, 1, 1), date(2018, 1, 1), ('year',))[0]['total_excl_vat']
+        self.assertEqual(total(), 2900)
+        invoice = Invoice.objects.get(date=date(2017, 1, 10))
+        with self.assertNumQueries(1):
+            self.assertEqual(total(), 2900)
+        invoice.days = 3
+        invoice.save()
+        self.assertEqual(total(), 3400)
+        CreditNote.objects.get().delete()
+        self.assertEqual(total(), 3500)
+
+
+class TimeEntryAPITest(TestCase):
+    def setUp(self):
+        self.project = create_project()
+        other_project = create_project('other', togglId='2')
+        TimeEntry.objects.bulk_create(
+            [TimeEntry(project=self.project, start=datetime(2017, 1, 1 + i // 3, 9, tzinfo=pytz.utc), duration=1,
+                       billable=i % 2 == 0, togglId=str(i)) for i in range(30)] +
+            [TimeEntry(project=other_project, start=datetime(2017, 1, 1, 9, tzinfo=pytz.utc), duration=1, togglId='99')])
+
+    def test_pages_follow_the_cursor(self):
+        url = f'/admin/time_entries/?project={self.project.pk}&start=2017-01-02&end=2017-01-09&limit=7'
+        ids = []
+        while url:
+            page = self.client.get(url).json()
+            ids += [row[0] for row in page['results']]
+            url = page['next']
+        expected = TimeEntry.objects.filter(project=self.project, start__gte=datetime(2017, 1, 2, tzinfo=pytz.utc),
+                                            start__lt=datetime(2017, 1, 10, tzinfo=pytz.utc)).order_by('start', 'pk')
+        self.assertEqual(ids, [entry.pk for entry in expected])
+        self.assertEqual(len(ids), 24)
+
+    def test_filters_and_errors(self):
+        page = self.client.get(f'/admin/time_entries/?billable=false&project={self.project.pk}').json()
+        self.assertEqual(len(page['results']), 15)
+        self.assertIsNone(page['next'])
+        self.assertEqual(self.client.get('/admin/time_entries/?project=12345').status_code, 404)
+        self.assertEqual(self.client.get('/admin/time_entries/?start=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/admin/time_entries/?cursor=xyz').status_code, 400)
+        self.assertEqual(self.client.get('/admin/time_entries/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/admin/time_entries/?limit=-1').status_code, 400)
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get('/admin/time_entries/?limit=10')
+        self.assertEqual(self.client.get('/admin/time_entries/?limit=10',
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        TimeEntry.objects.filter(togglId='99').update(duration=2)
+        self.assertEqual(self.client.get('/admin/time_entries/?limit=10',
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        project = create_project()
+        TimeEntry.objects.bulk_create([TimeEntry(project=project, start=datetime(2017, 1, 1, tzinfo=pytz.utc),
+                                                 duration=i, togglId=str(i)) for i in range(30)])
+
+    def test_rows_are_fetched_in_chunks(self):
+        with self.assertNumQueries(4):
+            chunks = list(export.iter_chunks(TimeEntry, chunk_size=10))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 10])
+        self.assertEqual(len({row[0] for chunk in chunks for row in chunk}), 30)
+
+    def test_csv_endpoint_streams_all_rows(self):
+        response = self.client.get('/admin/export/?model=timeentries')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(export.export_fields(TimeEntry)))
+        self.assertEqual(len(lines), 31)
+
+
+# file that tells crash_pdf_process to crash the first time, see RenderJobTest
+CRASH_MARKER = None
+
+
+def crash_pdf_process(content):
+    """
+    html_to_pdf that kills its process on the first call, or on every call without a crash marker
+    """
+    if CRASH_MARKER is None or not os.path.exists(CRASH_MARKER):
+        if CRASH_MARKER is not None:
+            open(CRASH_MARKER, 'w').close()
+        os._exit(1)
+    return b'%PDF'
+
+
+class RenderJobTest(TestCase):
+    def setUp(self):
+        self.invoice = Invoice.objects.create(project=create_project(), start=date(2017, 1, 1), end=date(2017, 1, 31),
+                                              delivery_date=date(2017, 1, 31), days=1)
+
+    def submit(self, **parameters):
+        return self.client.post('/admin/render_jobs/submit/', parameters)
+
+    def test_submit_validates_parameters(self):
+        self.assertEqual(self.client.get('/admin/render_jobs/submit/', {'kind': 'invoice'}).status_code, 405)
+        self.assertEqual(self.submit(kind='invoice', invoiceId='x').status_code, 400)
+        self.assertEqual(self.submit(kind='invoice', invoiceId=self.invoice.pk + 1).status_code, 400)
+        self.assertEqual(self.submit(kind='timesheet', start='yesterday').status_code, 400)
+        self.assertEqual(self.submit(kind='report').status_code, 400)
+        self.assertEqual(RenderJob.objects.count(), 0)
+
+    @mock.patch('invoicing.jobs.ProcessPoolExecutor', ThreadPoolExecutor)
+    @mock.patch('invoicing.jobs.html_to_pdf', return_value=b'%PDF')
+    def test_job_is_rendered_by_worker(self, html_to_pdf):
+        response = self.submit(kind='invoice', invoiceId=self.invoice.pk)
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual(self.client.get(job['status_url']).json()['status'], 'queued')
+        self.assertEqual(self.client.get(reverse('render_job_download', args=[job['id']])).status_code, 409)
+
+        self.assertEqual(Worker(processes=1, poll_interval=0.01).run(once=True), 1)
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], 'done')
+        download = self.client.get(status['download_url'])
+        self.assertEqual(download.content, b'%PDF')
+        self.assertIn(f'{self.invoice.number}_invoice_project.pdf', download['Content-Disposition'])
+
+    @mock.patch('invoicing.jobs.ProcessPoolExecutor', ThreadPoolExecutor)
+    @mock.patch('invoicing.jobs.html_to_pdf', return_value=b'%PDF')
+    def test_jobs_of_crashed_workers_are_run_again(self, html_to_pdf):
+        stale = RenderJob.objects.create(kind='invoice', parameters=json.dumps({'invoiceId': str(self.invoice.pk)}),
+                                         status='running', started_at=timezone.now() - timedelta(hours=1))
+        running = RenderJob.objects.create(kind='invoice', parameters=stale.parameters, status='running',
+                                           started_at=timezone.now())
+        Worker(processes=1, poll_interval=0.01).run(once=True)
+        self.assertEqual(RenderJob.objects.get(pk=stale.pk).status, 'done')
+        self.assertEqual(RenderJob.objects.get(pk=running.pk).status, 'running')
+
+
+    @skipUnless('fork' in multiprocessing.get_all_start_methods(), 'the crashing function is only known to forks')
+    @mock.patch('invoicing.jobs.ProcessPoolExecutor',
+                partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('fork')))
+    @mock.patch('invoicing.jobs.html_to_pdf', crash_pdf_process)
+    def test_worker_replaces_a_broken_pool(self):
+        global CRASH_MARKER
+        job = jobs.submit('invoice', {'invoiceId': str(self.invoice.pk)})
+        with tempfile.TemporaryDirectory() as directory:
+            CRASH_MARKER = os.path.join(directory, 'crashed')
+            try:
+                Worker(processes=1, poll_interval=0.01).run(once=True)
+            finally:
+                CRASH_MARKER = None
+        job.refresh_from_db()
+        self.assertEqual((job.status, bytes(job.pdf)), ('done', b'%PDF'))
+
+        # a job that keeps crashing its process fails instead of being retried forever
+        job = jobs.submit('invoice', {'invoiceId': str(self.invoice.pk)})
+        self.assertEqual(Worker(processes=1, poll_interval=0.01).run(once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('BrokenProcessPool', job.error)
+
+
+class RenderDocumentsTest(TestCase):
+    def setUp(self):
+        project = create_project()
+        self.invoices = [Invoice.objects.create(project=project, start=date(2017, month, 1), end=date(2017, month, 28),
+                                                delivery_date=date(2017, month, 28), days=1) for month in (1, 2)]
+        # the date of an invoice is set to today on save
+        for invoice in self.invoices:
+            Invoice.objects.filter(pk=invoice.pk).update(date=invoice.end)
+
+    @mock.patch('invoicing.documents.ProcessPoolExecutor', ThreadPoolExecutor)
+    @mock.patch('invoicing.rendering.html_to_pdf', return_value=b'%PDF')
+    def test_zip_of_selected_documents(self, html_to_pdf):
+        url = reverse('render_documents')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url, {'invoices': 'x'}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'month': '2017-13'}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'month': '2016-01'}).status_code, 400)
+
+        response = self.client.post(url, {'invoices': [self.invoices[0].pk], 'month': '2017-02'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(response.content)) as archive:
+            filenames = archive.namelist()
+            self.assertEqual([archive.read(filename) for filename in filenames], [b'%PDF', b'%PDF'])
+        self.assertEqual(sorted(filenames), sorted(f'{invoice.number}_invoice_project.pdf' for invoice in self.invoices))
+        self.assertEqual(response['Server-Timing'].count('pdf;desc='), 2)
+
+    def test_pdfs_render_in_spawned_processes(self):
+        # a spawned process imports the function sent to it without Django being set up
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            filename, pdf, seconds = pool.submit(timed_html_to_pdf, 'a.pdf', '<p>a</p>').result()
+        self.assertEqual(filename, 'a.pdf')
+        self.assertTrue(pdf.startswith(b'%PDF'))
+
+
+class NumberSequenceTest(TransactionTestCase):
+    def setUp(self):
+        self.project = create_project()
+
+    def create_invoice(self, **kwargs):
+        return Invoice.objects.create(project=self.project, start=date(2017, 1, 1), end=date(2017, 1, 31), days=1,
+                                      **kwargs)
+
+    def test_numbers_continue_after_existing_and_manual_numbers(self):
+        self.assertEqual(CreditNote.objects.create(project=self.project, amount=10).number, 1)
+        Invoice.objects.bulk_create([Invoice(project=self.project, number=7, date=date(2017, 1, 31),
+                                             start=date(2017, 1, 1), end=date(2017, 1, 31), days=1)])
+        self.assertEqual(self.create_invoice().number, 8)
+        self.assertEqual(self.create_invoice(number=20).number, 20)
+        self.assertEqual(self.create_invoice().number, 21)
+        self.assertEqual(NumberSequence.objects.get(name='invoice').last_number, 21)
+
+    def test_concurrent_saves_get_consecutive_numbers(self):
+        if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(connection.settings_dict['NAME']):
+            self.skipTest('threads need a file or PostgreSQL test database, run with --settings=webapp.settings_test')
+        errors = []
+
+        def create_invoices():
+            try:
+                for _ in range(25):
+                    self.create_invoice()
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create_invoices) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(Invoice.objects.values_list('number', flat=True)), list(range(1, 201)))
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def daily_durations(entries, start, end):
+    """
+    Sum the duration of time entries per calendar day (UTC) in a single pass.
+
+    Every entry is assigned to exactly one day by flooring its start to midnight, so an entry starting at
+    midnight is no longer counted on both the previous and the current day. The result is reindexed over
+    all days from start to end (both inclusive), days without entries get a duration of 0.
+
+    :param entries: DataFrame with at least a tz-aware `start` and a `duration` column
+    :param start: first day of the range (date, datetime or yyyy-mm-dd string)
+    :param end: last day of the range (date, datetime or yyyy-mm-dd string)
+    :return: Series of durations indexed by day
+    """
+    if len(entries) == 0:
+        return reindex_days(pd.Series([], dtype=float), start, end)
+    totals = entries.groupby(entries['start'].dt.floor('D'))['duration'].sum()
+    return reindex_days(totals, start, end)
+
+
+def reindex_days(totals, start, end):
+    """
+    Reindex per-day totals (e.g. the result of `TimeEntry.objects.daily_totals`) over all days from start to
+    end (both inclusive), days without a total get a duration of 0.
+    """
+    days = pd.date_range(start=start, end=end, tz='UTC')
+    return totals.reindex(days, fill_value=0.0).astype(float)
+
+
+def weekly_calendar(daily, calendar=None):
+    """
+    Arrange per-day durations in the structure expected by the calendar timesheet template: a list with one
+    dict per ISO week (in chronological order), mapping weekday names to
+    {'date': 'dd-mm', 'duration': ..., 'working': False for weekends and holidays}
+
+    :param daily: Series of durations indexed by day, as returned by `daily_durations`
+    :param calendar: numpy busdaycalendar of the working days, defaults to Monday to Friday
+    """
+    iso = daily.index.isocalendar()
+    working = np.is_busday(daily.index.tz_localize(None).values.astype('datetime64[D]'),
+                           busdaycal=calendar if calendar is not None else np.busdaycalendar())
+    days = pd.DataFrame({
+        'year': iso['year'].values,
+        'week': iso['week'].values,
+        'weekday': iso['day'].values,
+        'date': daily.index.strftime('%d-%m'),
+        'duration': daily.values,
+        'working': working,
+    })
+    weeks = []
+    for _, week in days.groupby(['year', 'week'], sort=True):
+        weeks.append({
+            WEEKDAYS[weekday - 1]: {'date': day, 'duration': duration, 'working': working}
+            for weekday, day, duration, working in zip(week['weekday'], week['date'], week['duration'].tolist(),
+                                                       week['working'].tolist())
+        })
+    return weeks
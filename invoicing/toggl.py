@@ -0,0 +1,202 @@
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from dateutil.parser import parse
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.utils import timezone
+from itertools import islice
+from . import billing
+from .models import Project, SyncState, TimeEntry, TogglImportWindow
+
+CHUNKS = {
+    'day': relativedelta(days=1),
+    'week': relativedelta(weeks=1),
+    'month': relativedelta(months=1),
+}
+
+
+def split_period(start, end, chunk='month'):
+    """
+    Split the period from start up to (not including) end in consecutive windows of a day, week or month
+    :return: list of (window start, window end) tuples, the window end is not included
+    """
+    windows = []
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + CHUNKS[chunk], end)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+class TimeEntryImporter(object):
+    """
+    Write time entries as returned by the toggl API to the database.
+
+    Entries are processed in batches: for every batch the already imported toggl ids are looked up with a single
+    query, new entries are inserted with one bulk insert and (if `update` is set) entries whose start, duration or
+    billable flag changed in toggl are updated. Entries flagged as deleted are removed. Nothing relies on unique constraint
+    violations, so the whole import can run in a single transaction, also on PostgreSQL.
+    """
+    def __init__(self, update=False, batch_size=500):
+        self.update = update
+        self.batch_size = batch_size
+        self.projects = None
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.elapsed = 0.0
+
+    @property
+    def processed(self):
+        return self.inserted + self.updated + self.skipped + self.deleted
+
+    def load_projects(self):
+        return {project.togglId: project for project in Project.objects.all()}
+
+    def to_time_entry(self, entry):
+        if entry.get('pid') is None:
+            raise RuntimeError('entry has no project: {}'.format(entry))
+        project = self.projects.get(str(entry['pid']))
+        if project is None:
+            print('unknown project: {}'.format(entry['pid']))
+            return None
+        if entry['duration'] < 0:
+            # toggl reports running time entries with a negative duration
+            return None
+        time_entry = TimeEntry(
+            project=project,
+            start=parse(entry['start']),
+            duration=entry['duration'] / 3600.0,
+            # entries without the flag (older exports) are billable, like before the flag was imported
+            billable=entry.get('billable') is not False,
+            togglId=str(entry['id'])
+        )
+        time_entry.normalize_duration()
+        return time_entry
+
+    def import_batch(self, entries):
+        deleted = {str(entry['id']) for entry in entries if entry.get('deleted')}
+        if deleted:
+            removed = TimeEntry.objects.filter(togglId__in=deleted).delete()[1].get(TimeEntry._meta.label, 0)
+            self.deleted += removed
+            self.skipped += len(deleted) - removed
+            entries = [entry for entry in entries if not entry.get('deleted')]
+
+        new_entries = {}
+        for entry in entries:
+            db_entry = self.to_time_entry(entry)
+            if db_entry is not None:
+                new_entries[db_entry.togglId] = db_entry
+        # unknown projects, running entries and duplicates within the batch
+        self.skipped += len(entries) - len(new_entries)
+
+        existing = TimeEntry.objects.filter(togglId__in=list(new_entries))\
+            .values_list('togglId', 'pk', 'start', 'duration', 'billable')
+        for togglId, pk, start, duration, billable in existing:
+            db_entry = new_entries.pop(togglId)
+            if self.update and (start != db_entry.start or duration != db_entry.duration or
+                                billable != db_entry.billable):
+                TimeEntry.objects.filter(pk=pk).update(start=db_entry.start, duration=db_entry.duration,
+                                                       duration_seconds=db_entry.duration_seconds,
+                                                       billable=db_entry.billable)
+                self.updated += 1
+            else:
+                self.skipped += 1
+
+        TimeEntry.objects.bulk_create(new_entries.values(), batch_size=self.batch_size)
+        self.inserted += len(new_entries)
+
+    def import_entries(self, entries):
+        """
+        Import an iterable of toggl time entries. The iterable is consumed batch by batch, so it can be a generator
+        streaming entries from the API.
+        """
+        t0 = time.perf_counter()
+        if self.projects is None:
+            self.projects = self.load_projects()
+        entries = iter(entries)
+        with transaction.atomic():
+            batch = list(islice(entries, self.batch_size))
+            while batch:
+                self.import_batch(batch)
+                batch = list(islice(entries, self.batch_size))
+        # bulk inserts and updates send no signals
+        billing.invalidate()
+        self.elapsed += time.perf_counter() - t0
+        return self
+
+    def summary(self):
+        throughput = self.processed / self.elapsed if self.elapsed else 0.0
+        return f'inserted: {self.inserted}, updated: {self.updated}, deleted: {self.deleted}, skipped: {self.skipped} ' \
+               f'({self.processed} entries in {self.elapsed:.2f}s, {throughput:.0f} entries/s)'
+
+
+class Backfill(object):
+    """
+    Import a long period from toggl by splitting it in windows that are fetched concurrently by a pool of threads
+    (the rate limit of the Toggl object is shared between them). All database writes happen in the calling thread
+    through a single importer. Each imported window is recorded as a TogglImportWindow, running the same backfill
+    again only fetches the windows that are missing.
+    """
+    def __init__(self, toggl, workspace_id, importer, workers=4):
+        self.toggl = toggl
+        self.workspace_id = workspace_id
+        self.importer = importer
+        self.workers = workers
+
+    def pending_windows(self, start, end, chunk):
+        done = set(TogglImportWindow.objects.filter(workspace_id=self.workspace_id).values_list('start', 'end'))
+        return [window for window in split_period(start, end, chunk) if window not in done]
+
+    def fetch(self, window):
+        window_start, window_end = window
+        return list(self.toggl.iterTimeEntries(window_start, window_end - timedelta(days=1), self.workspace_id))
+
+    def write(self, window, entries):
+        with transaction.atomic():
+            self.importer.import_entries(entries)
+            TogglImportWindow.objects.create(workspace_id=self.workspace_id, start=window[0], end=window[1],
+                                             entries=len(entries))
+        print('{0} - {1}: {2} entries'.format(window[0], window[1], len(entries)))
+
+    def run(self, start, end, chunk='month'):
+        """
+        :return: the number of windows that were imported
+        """
+        windows = iter(self.pending_windows(start, end, chunk))
+        imported = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # keep at most two windows per worker in flight, so fetched entries don't pile up in memory
+            running = {pool.submit(self.fetch, window): window for window in islice(windows, 2 * self.workers)}
+            try:
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.write(running.pop(future), future.result())
+                        imported += 1
+                        for window in islice(windows, 1):
+                            running[pool.submit(self.fetch, window)] = window
+            finally:
+                for future in running:
+                    future.cancel()
+        return imported
+
+
+def sync_since_last(toggl, workspace_id, importer):
+    """
+    Import all time entries of a workspace that were created, updated or deleted in toggl since the last sync,
+    and move the high-water mark (SyncState) forward. The mark is the time the changes were requested, so changes
+    made during the sync are picked up by the next one.
+    """
+    state = SyncState.objects.get(workspace_id=workspace_id)
+    synced_at = timezone.now()
+    entries = toggl.getTimeEntriesSince(state.last_synced_at, workspace_id)
+    with transaction.atomic():
+        importer.import_entries(entries)
+        state.last_synced_at = synced_at
+        state.save()
+    return state
@@ -1,11 +1,26 @@
-import pandas as pd
-from collections import defaultdict
-from django.http import HttpResponse
-from django.shortcuts import render
-from django.template import loader
+import binascii
+import hashlib
+import json
+import os
+import tempfile
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from django.views.decorators.http import require_POST
 from datetime import date, datetime, timedelta
-from weasyprint import HTML
-from .models import Client, CreditNote, Invoice, Profile, Project, TimeEntry
+from . import billing, jobs, reporting
+from .export import EXPORTS, iter_csv
+from .documents import render_documents, render_html, request_document, select_documents
+from .models import CreditNote, Invoice, Project, RenderJob, TimeEntry
+from .pdfcache import cached_pdf, get_pdf_cache
+from .rendering import html_to_pdf
 from .forms import InvoiceForm, TimesheetForm
 
 
@@ -15,6 +30,22 @@ def generate_timesheet(request):
     return render(request, 'timesheet_form.html', context)
 
 
+def overview(request):
+    """
+    Projects with their uninvoiced billable time, the invoices, and the uninvoiced time entries
+    """
+    totals = billing.uninvoiced_totals()
+    projects = list(Project.objects.order_by('name'))
+    for project in projects:
+        project.uninvoiced_days = totals.get(project.pk, 0) / 8.0
+    context = {
+        'projects': projects,
+        'invoices': Invoice.objects.select_related('project').order_by('-number'),
+        'uninvoiced_entries': billing.uninvoiced_entries().select_related('project').order_by('start'),
+    }
+    return render(request, 'overview.html', context)
+
+
 def display_timesheet(request):
     """
     get all time entries for a project and date range, and generate a timesheet.
@@ -26,54 +57,12 @@ def display_timesheet(request):
     """
     if request.method == 'GET':
         print(request.GET)
-        project_id = request.GET.get('project', '1')
-        start_str = request.GET.get('start', '2017-01-01')
-        end_str = request.GET.get('end', '2017-12-31')
-        time_unit = request.GET.get('unit', 'days')
-
-        project = Project.objects.get(pk=int(project_id))
-        client = Client.objects.get(pk=int(project.client_id))
-        user = Profile.objects.get(pk=int(project.user_id))
-        start = datetime.strptime(start_str, '%Y-%m-%d')
-        end = datetime.strptime(end_str, '%Y-%m-%d') + timedelta(days=1)
-        print('start: {0}'.format(start.isoformat()))
-        print('end: {0}'.format(end.isoformat()))
-        entries = TimeEntry.objects.get_queryset_df(start__gte=start, start__lte=end, project=project)
-        unit_hours = 8.0 if time_unit == 'days' else 1.0
-        entries['date'] = entries['start'].dt.date
-        total = entries['duration'].sum() / unit_hours
-        # entries['week'] = entries['start'].apply(lambda x: x.isocalendar()[1])
-        # entries['weekday'] = entries['start'].apply(lambda x: x.isoweekday())
-        entries_by_week_dict = defaultdict(dict)
-        for day in pd.date_range(start=start_str, end=end_str, tz="UTC"):
-            duration = entries[(entries['start'] >= day) & (entries['start'] <= day + timedelta(days=1))]['duration'].sum()
-            weeknr = str(day.isocalendar()[0]) + '_' + '{:02}'.format(day.isocalendar()[1])
-            print(weeknr)
-            weekday = ['', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'][day.isocalendar()[2]]
-            entries_by_week_dict[weeknr][weekday] = {'date': day.strftime('%d-%m'), 'duration': duration}
-        entries_by_week = [entries_by_week_dict[x] for x in sorted(entries_by_week_dict.keys())]
-
-        timeentries = entries.to_dict(orient='records')
-        start_out_str = start.strftime('%d-%m-%Y')
-        end_out_str = (end - timedelta(days=1)).strftime('%d-%m-%Y')
-
-        context = {
-            'client': client,
-            'description': 'description',
-            'end': end_out_str,
-            'start': start_out_str,
-            'entries_by_week': entries_by_week,
-            'timeentries': timeentries,
-            'total': '{0:.1f}'.format(total),
-            'time_unit': time_unit,
-            'user': user
-        }
-        template_file = project.timesheet_template if project.timesheet_template else 'calendar_timesheet.html'
-        content = loader.render_to_string(template_file, context, request, using=None)
+        document = request_document('timesheet', request.GET)
+        content = render_html(document, request)
         if request.GET.get('output', '') == 'pdf':
             response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename="{project}_timesheet_{start_out_str}_{end_out_str}.pdf"'
-            HTML(string=content).write_pdf(response, stylesheets=['invoicing/static/theme.css'])
+            response['Content-Disposition'] = f'attachment; filename="{document.filename}"'
+            html_to_pdf(content, response)
             return response
         return HttpResponse(content, None, 200)
 
@@ -88,14 +77,13 @@ def generate_invoice(request):
         start = date(*[int(x) for x in start_str.split('-')])
         end_str = request.POST.get('end')
         end = date(*[int(x) for x in end_str.split('-')])
-        days = request.POST.get('days')
+        # without days, the days of the time entries of the period are invoiced
+        days = request.POST.get('days') or None
         delivery_date = request.POST.get('delivery_date')
-        invoice = Invoice(project=project, start=start, end=end, days=days, delivery_date=delivery_date)
-        if project.default_invoice_description:
-            invoice.description = project.default_invoice_description
-        invoice.save()
-    existing_invoices = Invoice.objects.all().order_by('-number')
-    existing_creditnotes = CreditNote.objects.all().order_by('-number')
+        billing.create_invoice(project, start, end, delivery_date=delivery_date, days=days,
+                               description=project.default_invoice_description or None)
+    existing_invoices = Invoice.objects.select_related('project').order_by('-number')
+    existing_creditnotes = CreditNote.objects.select_related('project').order_by('-number')
     context = {'form': form, 'invoices': existing_invoices, 'creditnotes': existing_creditnotes}
     return render(request, 'invoice_form.html', context)
 
@@ -108,51 +96,12 @@ def display_invoice(request):
       - invoiceId
     """
     if request.method == 'GET':
-        invoice_id = request.GET.get('invoiceId', '1')
-        invoice = Invoice.objects.get(pk=int(invoice_id))
-        invoice_date_format = '%d/%m/%Y'
-        total_price = invoice.days * invoice.project.rate
-        total_vat = invoice.days * invoice.project.rate * invoice.vat_rate
-        invoice_items = [
-            {'description': '{} dagen ontwikkeling aan €{} per dag (waarvan 15% auteursrechten)'.format(invoice.days, invoice.project.rate),
-             'price': '{0:.2f}'.format(invoice.days * invoice.project.rate),
-             'vat': '{0:.2f}'.format(invoice.days * invoice.project.rate * invoice.vat_rate),
-             'vat_rate': int(invoice.project.vat_rate * 100)}]
-        if invoice.invoiceitem_set.all().count() > 0:
-            for item in invoice.invoiceitem_set.all():
-                item_vat_rate = item.vat_rate if item.vat_rate else invoice.vat_rate
-                invoice_items.append({
-                    'description': item.description,
-                    'price': '{0:.2f}'.format(item.price),
-                    'vat': '{0:.2f}'.format(item.price * item_vat_rate),
-                    'vat_rate': int(item_vat_rate * 100)})
-                total_price += item.price
-                total_vat += item.price * item_vat_rate
-
-        context = {
-            'client': invoice.project.client,
-            'user': invoice.project.user,
-            'invoice_number': invoice.number,
-            'start': invoice.start.strftime(invoice_date_format),
-            'end': invoice.end.strftime(invoice_date_format),
-            'invoice_date': invoice.date.strftime(invoice_date_format),
-            'invoice_delivery_date': invoice.delivery_date.strftime(invoice_date_format),
-            'invoice_items': invoice_items,
-            'description': invoice.description,
-            'nr_of_days': '{0:.2f}'.format(invoice.days),
-            'rate': '{0:.2f}'.format(invoice.project.rate),
-            'total': '{0:.2f}'.format(total_price),
-            'vat': '{0:.2f}'.format(total_vat) if total_vat > 0 else '0.00 (customer is VAT exempt)',
-            'total_vat': '{0:.2f}'.format(float(total_price) + float(total_vat)),
-        }
-
-        template = invoice.project.invoice_template if not invoice.is_credit_invoice else invoice.project.credit_template
-
-        content = loader.render_to_string(template, context, request, using=None)
+        document = request_document('invoice', request.GET)
+        content = render_html(document, request)
         if request.GET.get('output', '') == 'pdf':
             response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename="{invoice.number}_invoice_{invoice.project}.pdf"'
-            HTML(string=content).write_pdf(response, stylesheets=['invoicing/static/theme.css'])
+            response['Content-Disposition'] = f'attachment; filename="{document.filename}"'
+            response.write(cached_pdf(document, content))
             return response
         return HttpResponse(content, None, 200)
 
@@ -162,42 +111,238 @@ def display_creditnote(request):
     Display the creditnote
     """
     if request.method == 'GET':
-        creditnote_id = request.GET.get('creditnoteId', '1')
-        creditnote = CreditNote.objects.get(pk=int(creditnote_id))
-        date_format = '%d/%m/%Y'
-        total_price = creditnote.amount
-        total_vat = creditnote.amount * creditnote.vat_rate
-
-        context = {
-            'client': creditnote.project.client,
-            'user': creditnote.project.user,
-            'creditnote_number': creditnote.number,
-            'creditnote_date': creditnote.date.strftime(date_format),
-            'description': creditnote.description,
-            'total': '{0:.2f}'.format(total_price),
-            'vat': '{0:.2f}'.format(total_vat),
-            'total_vat': '{0:.2f}'.format(float(total_price) + float(total_vat)),
-        }
-
-        template = creditnote.project.credit_template
-
-        content = loader.render_to_string(template, context, request, using=None)
+        document = request_document('creditnote', request.GET)
+        content = render_html(document, request)
         if request.GET.get('output', '') == 'pdf':
             response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename="{creditnote.number}_creditnote_{creditnote.project}.pdf"'
-            HTML(string=content).write_pdf(response, stylesheets=['invoicing/static/theme.css'])
+            response['Content-Disposition'] = f'attachment; filename="{document.filename}"'
+            response.write(cached_pdf(document, content))
             return response
         return HttpResponse(content, None, 200)
 
 
+TIME_ENTRY_FIELDS = ('id', 'project_id', 'start', 'duration', 'duration_unit', 'billable')
+
+
+def encode_cursor(start, pk):
+    return urlsafe_b64encode(f'{start.isoformat()}|{pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    :return: (start, id) of the last entry of the previous page
+    """
+    try:
+        start_str, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        start = parse_datetime(start_str)
+        if start is not None:
+            return start, int(pk)
+    except (TypeError, ValueError, binascii.Error):
+        pass
+    raise ValueError(f'Invalid cursor: {cursor}')
+
+
 def get_time_entries(request):
-    if request.method == 'GET':
-        project_id = request.GET.get('project', '')
-        start_str = request.GET.get('start', '')
-        end_str = request.GET.get('end', '')
-
-        project = Project.objects.get(pk=int(project_id))
-        start = datetime.strptime(start_str, '%Y-%m-%d')
-        end = datetime.strptime(end_str, '%Y-%m-%d')
-        entries = TimeEntry.objects.get_queryset_df(start__gte=start, start__lte=end, project=project)
-        return HttpResponse(entries.T.to_json())
\ No newline at end of file
+    """
+    Time entries as JSON, ordered by start, one page at a time. The next page starts after the (start, id) of the
+    last entry of this page (keyset pagination), so every page is an index range scan, however deep it is.
+    A page that did not change since the client fetched it is answered with 304 Not Modified (ETag/If-None-Match).
+
+    Expected query parameters (all optional):
+      - project: project id
+      - billable: true or false
+      - start, end: date range (yyyy-mm-dd, both inclusive)
+      - limit: page size (1 to 5000, default 500)
+      - cursor: the cursor of the next page, as returned in the previous response
+    """
+    entries = TimeEntry.objects.all()
+    try:
+        if 'project' in request.GET:
+            entries = entries.for_project(get_object_or_404(Project, pk=int(request.GET['project'])))
+        if 'billable' in request.GET:
+            if request.GET['billable'].lower() in ('true', '1', 'yes'):
+                entries = entries.billable()
+            else:
+                entries = entries.filter(billable=False)
+        if 'start' in request.GET:
+            entries = entries.filter(start__gte=datetime.strptime(request.GET['start'], '%Y-%m-%d').replace(tzinfo=utc))
+        if 'end' in request.GET:
+            end = datetime.strptime(request.GET['end'], '%Y-%m-%d').replace(tzinfo=utc) + timedelta(days=1)
+            entries = entries.filter(start__lt=end)
+        if 'cursor' in request.GET:
+            start, pk = decode_cursor(request.GET['cursor'])
+            entries = entries.filter(Q(start__gt=start) | Q(start=start, pk__gt=pk))
+        limit = min(int(request.GET.get('limit', 500)), 5000)
+        if limit < 1:
+            raise ValueError(f'Invalid limit: {limit}')
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+
+    # one row more than the page size tells whether there is a next page
+    rows = list(entries.order_by('start', 'pk').values_list(*TIME_ENTRY_FIELDS)[:limit + 1])
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        parameters = request.GET.copy()
+        parameters['cursor'] = encode_cursor(rows[-1][2], rows[-1][0])
+        next_url = f'{request.path}?{parameters.urlencode()}'
+    content = json.dumps({'fields': TIME_ENTRY_FIELDS, 'results': rows, 'next': next_url}, cls=DjangoJSONEncoder)
+
+    etag = '"{}"'.format(hashlib.md5(content.encode()).hexdigest())
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def pdf_cache_stats(request):
+    """
+    Hits and misses of the pdf cache, as counted by the server process that handles the request
+    """
+    pdf_cache = get_pdf_cache()
+    if pdf_cache is None:
+        return JsonResponse({'enabled': False})
+    return JsonResponse(dict(pdf_cache.stats(), enabled=True, pid=os.getpid()))
+
+
+def render_job_json(job):
+    result = {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'status_url': reverse('render_job_status', args=[job.pk]),
+    }
+    if job.status == 'done':
+        result['download_url'] = reverse('render_job_download', args=[job.pk])
+    return result
+
+
+@require_POST
+def submit_render_job(request):
+    """
+    Queue a pdf to be rendered by the render-worker command.
+
+    Expected POST parameters:
+      - kind: timesheet, invoice or creditnote
+      - the query parameters of display_timesheet, display_invoice or display_creditnote
+    """
+    parameters = {key: value for key, value in request.POST.items()
+                  if key not in ('kind', 'output', 'csrfmiddlewaretoken')}
+    try:
+        job = jobs.submit(request.POST.get('kind', ''), parameters)
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    return JsonResponse(render_job_json(job), status=202)
+
+
+def render_job_status(request, job_id):
+    job = get_object_or_404(RenderJob.objects.defer('pdf'), pk=job_id)
+    return JsonResponse(render_job_json(job))
+
+
+def download_render_job(request, job_id):
+    job = get_object_or_404(RenderJob, pk=job_id)
+    if job.status != 'done':
+        return JsonResponse(render_job_json(job), status=409)
+    response = HttpResponse(bytes(job.pdf), content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="{job.filename}"'
+    return response
+
+
+@require_POST
+def render_documents_zip(request):
+    """
+    Render invoices and creditnotes to pdf in parallel and return them in a zip file, like the render-documents
+    command. The render time of every pdf is reported in the Server-Timing header.
+
+    Expected POST parameters:
+      - invoices: invoice id, can be repeated
+      - creditnotes: creditnote id, can be repeated
+      - month: render all invoices dated in this month (yyyy-mm)
+    """
+    try:
+        invoice_ids = [int(pk) for pk in request.POST.getlist('invoices')]
+        creditnote_ids = [int(pk) for pk in request.POST.getlist('creditnotes')]
+        month_start = datetime.strptime(request.POST['month'], '%Y-%m') if request.POST.get('month') else None
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    month = (month_start.year, month_start.month) if month_start else None
+    documents = select_documents(invoice_ids, creditnote_ids, month)
+    if not documents:
+        return HttpResponseBadRequest('No documents selected')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'documents.zip')
+        report = render_documents(documents, path)
+        with open(path, 'rb') as f:
+            response = HttpResponse(f.read(), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="documents.zip"'
+    response['Server-Timing'] = ', '.join('pdf;desc="{0}";dur={1:.1f}'.format(
+        document['filename'].replace('"', ''), document['seconds'] * 1000) for document in report)
+    return response
+
+
+def report_period(request):
+    """
+    The start (inclusive) and end (exclusive) query parameters of a report (yyyy-mm-dd), this year by default
+    """
+    today = date.today()
+    start = datetime.strptime(request.GET['start'], '%Y-%m-%d').date() if 'start' in request.GET else date(today.year, 1, 1)
+    end = datetime.strptime(request.GET['end'], '%Y-%m-%d').date() if 'end' in request.GET else date(today.year + 1, 1, 1)
+    return start, end
+
+
+def revenue_report(request):
+    """
+    Invoiced amounts grouped by year, month, client and/or project.
+
+    Expected query parameters:
+      - start, end: invoice date range (yyyy-mm-dd, end not included), default this year
+      - by: comma separated grouping keys, default year,month,client,project
+    """
+    keys = tuple(request.GET.get('by', 'year,month,client,project').split(','))
+    try:
+        start, end = report_period(request)
+        rows = reporting.cached('revenue', reporting.revenue, start, end, keys)
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    return JsonResponse({'start': start, 'end': end, 'rows': rows})
+
+
+def vat_report(request):
+    """
+    VAT invoiced per quarter, for the start and end query parameters (see revenue_report)
+    """
+    try:
+        start, end = report_period(request)
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    return JsonResponse({'start': start, 'end': end, 'rows': reporting.cached('vat', reporting.vat_per_quarter, start, end)})
+
+
+def unpaid_report(request):
+    """
+    Outstanding amounts of the unpaid invoices per age bucket
+    """
+    today = date.today()
+    return JsonResponse({'date': today, 'rows': reporting.cached('unpaid', reporting.unpaid_aging, today)})
+
+
+def export_csv(request):
+    """
+    Stream all rows of a model as csv, see the export command for the parquet format.
+
+    Expected query parameters:
+      - model: timeentries, invoices or invoiceitems
+    """
+    name = request.GET.get('model', '')
+    if name not in EXPORTS:
+        return HttpResponseBadRequest(f'Unknown export: {name}')
+    response = StreamingHttpResponse(iter_csv(EXPORTS[name]), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{name}.csv"'
+    return response
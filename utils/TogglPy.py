@@ -7,13 +7,20 @@
 #   - Ported to Python 3,
 #   - Uses requests instead of urllib
 #   - Added a getTimeEntries method
+#   - Pooled HTTP session with retries, paged iterTimeEntries
+#   - Optional client side rate limit, shared between threads
+#   - Added a getTimeEntriesSince method (incremental sync)
 #--------------------------------------------------------------
 from datetime import datetime
+import threading
+import time
 # for making requests
 import logging
 logging.basicConfig(level=logging.INFO)
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 # parsing json data
 import json
@@ -25,11 +32,12 @@ class Endpoints():
     WORKSPACES = "https://api.track.toggl.com/api/v8/workspaces"
     CLIENTS = "https://api.track.toggl.com/api/v8/clients"
     PROJECTS = "https://api.track.toggl.com/api/v8/projects"
-    REPORT_WEEKLY = "api.track.toggl.com/reports/api/v2/weekly"
-    REPORT_DETAILED = "api.track.toggl.com/reports/api/v2/details"
-    REPORT_SUMMARY = "api.track.toggl.com/reports/api/v2/summary"
+    REPORT_WEEKLY = "https://api.track.toggl.com/reports/api/v2/weekly"
+    REPORT_DETAILED = "https://api.track.toggl.com/reports/api/v2/details"
+    REPORT_SUMMARY = "https://api.track.toggl.com/reports/api/v2/summary"
     START_TIME = "https://api.track.toggl.com/api/v8/time_entries/start"
     TIME_ENTRIES = "https://api.track.toggl.com/api/v8/time_entries"
+    MY_TIME_ENTRIES = "https://api.track.toggl.com/api/v9/me/time_entries"
     @staticmethod
     def STOP_TIME(pid):
         return "https://www.toggl.com/api/v8/time_entries/" + str(pid) + "/stop"
@@ -50,6 +58,25 @@ class Toggl():
     # default API user agent value
     user_agent = "TogglPy"
 
+    # responses that are worth retrying: rate limited or a temporary server error
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=5, backoff_factor=0.5, pool_maxsize=10, rate_limit=None):
+        '''
+        all requests go through one pooled session (keep-alive), GET requests that fail with one of the
+        retry_statuses are retried `retries` times with an exponential backoff (backoff_factor * 2^n seconds).
+        When a rate_limit is given, at most that many requests per second are sent, also when the object is
+        shared between threads.
+        '''
+        self.min_interval = 1.0 / rate_limit if rate_limit else 0.0
+        self.next_request_at = 0.0
+        self.throttle_lock = threading.Lock()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=self.retry_statuses)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     #-------------------------------------------------------------
     # Auxiliary methods
     #-------------------------------------------------------------
@@ -57,6 +84,17 @@ class Toggl():
     def decodeJSON(self, jsonString):
         return json.JSONDecoder().decode(jsonString)
 
+    def throttle(self):
+        '''wait until the next request is allowed by the rate limit'''
+        if not self.min_interval:
+            return
+        with self.throttle_lock:
+            now = time.monotonic()
+            wait = self.next_request_at - now
+            self.next_request_at = max(now, self.next_request_at) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
     #-------------------------------------------------------------
     # Methods that modify the headers to control our HTTP requests
     #-------------------------------------------------------------
@@ -73,12 +111,13 @@ class Toggl():
 
     def requestRaw(self, endpoint, parameters=None):
         '''make a request to the toggle api at a certain endpoint and return the RAW page data (usually JSON)'''
+        self.throttle()
         if parameters == None:
-            return requests.get(endpoint, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token'))
+            return self.session.get(endpoint, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token'))
         else:
             if 'user_agent' not in parameters:
                 parameters['user_agent'] =self.user_agent # add our class-level user agent in there
-            return requests.get(endpoint, headers=self.headers, params=parameters, auth=HTTPBasicAuth(self.api_token, 'api_token')) # make request and read the response
+            return self.session.get(endpoint, headers=self.headers, params=parameters, auth=HTTPBasicAuth(self.api_token, 'api_token')) # make request and read the response
 
     def request(self, endpoint, parameters=None):
         '''make a request to the toggle api at a certain endpoint and return the page data as a parsed JSON dict'''
@@ -88,10 +127,11 @@ class Toggl():
 
     def postRequest(self, endpoint, parameters=None):
         '''make a POST request to the toggle api at a certain endpoint and return the RAW page data (usually JSON)'''
+        self.throttle()
         if parameters == None:
-            return requests.post(endpoint, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token'))
+            return self.session.post(endpoint, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token'))
         else:
-            return requests.post(endpoint, data=parameters, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token')) # make request and read the response
+            return self.session.post(endpoint, data=parameters, headers=self.headers, auth=HTTPBasicAuth(self.api_token, 'api_token')) # make request and read the response
 
     #----------------------------------
     # Methods for managing Time Entries
@@ -176,6 +216,58 @@ class Toggl():
             entries = [x for x in entries if str(x['pid']) == str(projectid)]
         return entries
 
+    def getTimeEntriesSince(self, since, workspace_id=None):
+        """
+        retrieve all time entries that were created, updated or deleted since a given (timezone aware) datetime.
+        Toggl only keeps track of changes of the last 3 months. Deleted entries have 'deleted' set to True.
+        :return: array of time entries in the format of getTimeEntries
+        """
+        entries = self.request(Endpoints.MY_TIME_ENTRIES, parameters={'since': int(since.timestamp())})
+        return [{
+            'id': entry['id'],
+            'pid': entry.get('project_id'),
+            'description': entry.get('description'),
+            'start': entry['start'],
+            'stop': entry.get('stop'),
+            'duration': entry['duration'],
+            'billable': entry.get('billable'),
+            'at': entry.get('at'),
+            'deleted': entry.get('server_deleted_at') is not None,
+        } for entry in entries if workspace_id is None or entry['workspace_id'] == int(workspace_id)]
+
+    def iterTimeEntries(self, start_date, end_date, workspace_id, projectid=None):
+        """
+        generator over all time entries during a given period (both days inclusive), paging through the detailed
+        report endpoint so only one page of entries is held in memory. Filtering on project happens server side.
+        The entries are yielded in the format of getTimeEntries (duration in seconds, pid, stop)
+        :return: generator of time entries
+        """
+        data = {
+            'workspace_id': workspace_id,
+            'since': start_date.strftime('%Y-%m-%d'),
+            'until': end_date.strftime('%Y-%m-%d'),
+            'page': 1,
+        }
+        if projectid:
+            data['project_ids'] = projectid
+
+        while True:
+            report = self.request(Endpoints.REPORT_DETAILED, parameters=dict(data))
+            for entry in report['data']:
+                yield {
+                    'id': entry['id'],
+                    'pid': entry['pid'],
+                    'description': entry.get('description'),
+                    'start': entry['start'],
+                    'stop': entry['end'],
+                    'duration': entry['dur'] / 1000.0,
+                    'billable': entry.get('is_billable'),
+                    'at': entry.get('updated'),
+                }
+            if not report['data'] or data['page'] * report['per_page'] >= report['total_count']:
+                break
+            data['page'] += 1
+
 
     #-----------------------------------
     # Methods for getting workspace data
@@ -79,6 +79,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # writers wait for each other instead of failing with 'database is locked'
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -122,6 +124,21 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+# Cache of rendered invoice and creditnote pdfs: 'disk' (least recently used files are removed when the directory
+# grows beyond PDF_CACHE_MAX_BYTES), 'django' (the default Django cache) or None to disable it
+
+PDF_CACHE_BACKEND = 'disk'
+PDF_CACHE_DIR = os.path.join(BASE_DIR, 'pdf_cache')
+PDF_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Number invoices and creditnotes per year (20170001, 20170002, ...) instead of one sequence for all years
+INVOICE_NUMBERS_PER_YEAR = False
+
+# Name of the work calendar (holidays and working days of the week) used when a report is not made for a specific
+# user, None for Monday to Friday without holidays
+WORK_CALENDAR = None
+
+
 try:
     from invoicing.settings_local import *
 except ImportError as e:
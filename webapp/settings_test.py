@@ -0,0 +1,16 @@
+"""
+Settings to run the tests against a file database instead of the default in-memory database, so that tests can use
+the database from several threads (e.g. the concurrent invoice numbering test):
+
+    python manage.py test --settings=webapp.settings_test
+"""
+import os
+import tempfile
+
+from .settings import *  # noqa
+
+# a new file for every run: a file left behind by an interrupted run never blocks the next one
+DATABASES = {
+    'default': dict(DATABASES['default'],
+                    TEST={'NAME': os.path.join(tempfile.gettempdir(), f'invoicing_test_{os.getpid()}.sqlite3')}),
+}
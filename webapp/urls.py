@@ -15,7 +15,9 @@ Including another URLconf
 """
 from django.conf.urls import url
 from django.contrib import admin
-from invoicing.views import display_creditnote, display_timesheet, generate_timesheet, display_invoice, generate_invoice, get_time_entries
+from invoicing.views import display_creditnote, display_timesheet, generate_timesheet, display_invoice, generate_invoice, get_time_entries, \
+    submit_render_job, render_job_status, download_render_job, revenue_report, vat_report, unpaid_report, \
+    export_csv, overview, pdf_cache_stats, render_documents_zip
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
@@ -25,4 +27,14 @@ urlpatterns = [
     url(r'^admin/invoice/', display_invoice, name='display_invoice'),
     url(r'^admin/generate_invoice/', generate_invoice),
     url(r'^admin/time_entries/', get_time_entries),
+    url(r'^admin/render_jobs/submit/', submit_render_job, name='submit_render_job'),
+    url(r'^admin/render_jobs/(?P<job_id>\d+)/$', render_job_status, name='render_job_status'),
+    url(r'^admin/render_jobs/(?P<job_id>\d+)/download/', download_render_job, name='render_job_download'),
+    url(r'^admin/render_documents/', render_documents_zip, name='render_documents'),
+    url(r'^admin/reports/revenue/', revenue_report, name='revenue_report'),
+    url(r'^admin/reports/vat/', vat_report, name='vat_report'),
+    url(r'^admin/reports/unpaid/', unpaid_report, name='unpaid_report'),
+    url(r'^admin/export/', export_csv, name='export_csv'),
+    url(r'^admin/overview/', overview, name='overview'),
+    url(r'^admin/pdf_cache/', pdf_cache_stats, name='pdf_cache_stats'),
 ]